@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+"""
+Local stand in for the subset of the Redash API used by redasher,
+filled with generated objects, to measure checkouts and uploads.
+
+Run it alone with:
+
+    python benchmarks/fakeredash.py --queries 1000 --dashboards 50 --latency 0.02
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Repeated names to force slug collisions, Japanese ones included
+queryNames = [
+    '新しいクエリ',
+    'New Query',
+    '売上集計',
+    'ユーザー数の推移',
+    'Daily KPI',
+]
+visualizationNames = ['Chart', 'グラフ', 'Untitled']
+dashboardNames = ['ダッシュボード', 'KPI', 'Sales overview']
+
+
+class FakeRedash(object):
+    """Keeps the objects of a fake Redash instance
+    and counts the requests it receives.
+    """
+    def __init__(self, latency=0.0, version='10.1.0', resultRows=20):
+        self.latency = latency
+        self.version = version
+        self.resultRows = resultRows
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.datasources = {}
+        self.queries = {}
+        self.visualizations = {}
+        self.dashboards = {}
+        self.widgets = {}
+        self.lastId = 0
+
+    def nextId(self):
+        with self.lock:
+            self.lastId += 1
+            return self.lastId
+
+    def generate(self, queries=100, dashboards=10, widgets=5, seed=0):
+        """Fills the instance with the given number of queries,
+        dashboards and widgets per dashboard, the same for a given seed.
+        """
+        rnd = random.Random(seed)
+        timestamp = '2023-01-01T00:00:00.000000+00:00'
+        for name in ['Postgres', 'データウェアハウス']:
+            id = self.nextId()
+            self.datasources[id] = dict(
+                id=id,
+                name=name,
+                type='pg',
+                syntax='sql',
+                options=dict(host='localhost', dbname='db{}'.format(id)),
+                groups={'2': False},
+                paused=0,
+                queue_name='queries',
+                scheduled_queue_name='scheduled_queries',
+            )
+        datasourceIds = list(self.datasources)
+
+        for n in range(queries):
+            id = self.nextId()
+            parameters = []
+            if self.queries and rnd.random() < 0.1:
+                parameters.append(dict(
+                    name='filter',
+                    title='Filter',
+                    type='query',
+                    queryId=rnd.choice(list(self.queries)),
+                    value=None,
+                ))
+            self.queries[id] = dict(
+                id=id,
+                name=rnd.choice(queryNames),
+                description=None,
+                query='SELECT count(*)\nFROM table_{}\nWHERE id > {}\n'.format(n % 97, n),
+                query_hash='{:032x}'.format(rnd.getrandbits(128)),
+                data_source_id=rnd.choice(datasourceIds),
+                schedule=None,
+                options=dict(parameters=parameters),
+                tags=rnd.sample(['sales', 'kpi', '集計', 'daily'], rnd.randint(0, 2)),
+                is_archived=False,
+                is_draft=False,
+                is_safe=True,
+                version=1,
+                latest_query_data_id=self.nextId(),
+                api_key='key{}'.format(id),
+                user=dict(id=1, name='admin'),
+                last_modified_by=dict(id=1, name='admin'),
+                created_at=timestamp,
+                updated_at=timestamp,
+            )
+            self._addVisualization(id, 'TABLE', 'Table', {})
+            for i in range(rnd.randint(0, 2)):
+                self._addVisualization(id, 'CHART',
+                    rnd.choice(visualizationNames),
+                    dict(
+                        globalSeriesType=rnd.choice(['line', 'column', 'pie']),
+                        columnMapping={'day': 'x', 'count': 'y'},
+                        seriesOptions={
+                            'series{}'.format(s): dict(color='#{:06x}'.format(rnd.getrandbits(24)))
+                            for s in range(rnd.randint(1, 20))
+                        },
+                    ),
+                )
+
+        visualizationIds = list(self.visualizations)
+        for n in range(dashboards):
+            id = self.nextId()
+            self.dashboards[id] = dict(
+                id=id,
+                name=rnd.choice(dashboardNames),
+                slug='dashboard-{}'.format(id),
+                tags=[],
+                is_archived=False,
+                is_draft=False,
+                is_favorite=False,
+                dashboard_filters_enabled=False,
+                layout=[],
+                can_edit=True,
+                version=1,
+                user_id=1,
+                user=dict(id=1, name='admin'),
+                created_at=timestamp,
+                updated_at=timestamp,
+            )
+            for i in range(widgets):
+                self._addWidget(id,
+                    rnd.choice(visualizationIds) if visualizationIds and rnd.random() < 0.9 else None,
+                    '' if rnd.random() < 0.9 else '## メモ {}'.format(i),
+                    dict(position=dict(col=i%2*3, row=i//2*8, sizeX=3, sizeY=8)),
+                )
+        return self
+
+    def _addVisualization(self, queryId, type, name, options, description=''):
+        id = self.nextId()
+        self.visualizations[id] = dict(
+            id=id,
+            query_id=queryId,
+            type=type,
+            name=name,
+            description=description,
+            options=options,
+            created_at='2023-01-01T00:00:00.000000+00:00',
+            updated_at='2023-01-01T00:00:00.000000+00:00',
+        )
+        return id
+
+    def _addWidget(self, dashboardId, visualizationId, text, options, width=1):
+        id = self.nextId()
+        self.widgets[id] = dict(
+            id=id,
+            dashboard_id=dashboardId,
+            visualization_id=visualizationId,
+            text=text,
+            width=width,
+            options=options,
+            created_at='2023-01-01T00:00:00.000000+00:00',
+            updated_at='2023-01-01T00:00:00.000000+00:00',
+        )
+        return id
+
+    def _touch(self, anObject):
+        anObject['version'] = anObject.get('version', 0) + 1
+        anObject['updated_at'] = '2024-01-01T00:00:{:02d}.000000+00:00'.format(
+            anObject['version'] % 60)
+
+    # Full representations
+
+    def visualization(self, id):
+        visualization = dict(self.visualizations[id])
+        del visualization['query_id']
+        return visualization
+
+    def query(self, id):
+        return dict(self.queries[id],
+            visualizations=[
+                self.visualization(visId)
+                for visId, vis in self.visualizations.items()
+                if vis['query_id'] == id
+            ],
+        )
+
+    def queryResult(self, id):
+        "The latest result of a query, generated from its id"
+        for query in self.queries.values():
+            if query.get('latest_query_data_id') == id:
+                break
+        else:
+            return None
+        return dict(query_result=dict(
+            id=id,
+            query_hash=query['query_hash'],
+            query=query['query'],
+            data=dict(
+                columns=[
+                    dict(name='day', friendly_name='day', type='date'),
+                    dict(name='count', friendly_name='count', type='integer'),
+                    dict(name='ratio', friendly_name='ratio', type='float'),
+                    dict(name='label', friendly_name='label', type='string'),
+                ],
+                rows=[
+                    dict(
+                        day='2023-{:02d}-{:02d}'.format(n // 28 % 12 + 1, n % 28 + 1),
+                        count=(id * 7919 + n * 104729) % 100000,
+                        ratio=round(((id + n) % 1000) / 999., 4),
+                        label=['売上', 'sales', None, 'x "quoted"\nline'][n % 4],
+                    )
+                    for n in range(self.resultRows)
+                ],
+            ),
+            data_source_id=query['data_source_id'],
+            runtime=0.01,
+            retrieved_at='2023-01-01T00:00:00.000000+00:00',
+        ))
+
+    def widget(self, id):
+        widget = dict(self.widgets[id])
+        visId = widget.pop('visualization_id')
+        if visId:
+            query = dict(self.queries[self.visualizations[visId]['query_id']])
+            widget['visualization'] = dict(self.visualization(visId), query=query)
+        return widget
+
+    def dashboard(self, idOrSlug):
+        for dashboard in self.dashboards.values():
+            if str(dashboard['id']) == idOrSlug or dashboard['slug'] == idOrSlug:
+                break
+        else:
+            return None
+        return dict(dashboard,
+            widgets=[
+                self.widget(widgetId)
+                for widgetId, widget in self.widgets.items()
+                if widget['dashboard_id'] == dashboard['id']
+            ],
+        )
+
+    # Request handling, returns (status, json)
+
+    def get(self, path, params):
+        if path == 'status.json':
+            return 200, dict(version=self.version)
+        if path == 'api/session':
+            return 200, dict(user=dict(id=1))
+        if path == 'api/data_sources':
+            return 200, [
+                dict(id=ds['id'], name=ds['name'], type=ds['type'])
+                for ds in self.datasources.values()
+            ]
+        if path == 'api/queries':
+            return 200, self._page(self.queries.values(), params)
+        if path == 'api/dashboards':
+            return 200, self._page(self.dashboards.values(), params)
+        if path == 'api/users':
+            return 200, self._page([dict(id=1, name='admin')], params)
+
+        match = re.match(r'api/data_sources/(\d+)$', path)
+        if match and int(match.group(1)) in self.datasources:
+            return 200, self.datasources[int(match.group(1))]
+        match = re.match(r'api/queries/(\d+)$', path)
+        if match and int(match.group(1)) in self.queries:
+            return 200, self.query(int(match.group(1)))
+        match = re.match(r'api/query_results/(\d+)$', path)
+        if match:
+            result = self.queryResult(int(match.group(1)))
+            if result:
+                return 200, result
+        match = re.match(r'api/dashboards/([^/]+)$', path)
+        if match:
+            dashboard = self.dashboard(match.group(1))
+            if dashboard:
+                return 200, dashboard
+        return 404, dict(message="Couldn't find resource")
+
+    def _page(self, objects, params):
+        objects = list(objects)
+        page = int(params.get('page', ['1'])[0])
+        pageSize = min(250, int(params.get('page_size', ['25'])[0]))
+        return dict(
+            count=len(objects),
+            page=page,
+            page_size=pageSize,
+            results=objects[(page-1)*pageSize:page*pageSize],
+        )
+
+    def post(self, path, data):
+        with self.lock:
+            return self._post(path, data)
+
+    def _post(self, path, data):
+        if path == 'api/queries':
+            id = self.lastId = self.lastId + 1
+            self.queries[id] = dict(data,
+                id=id,
+                tags=[],
+                version=1,
+                options=data.get('options') or {},
+                created_at='2024-01-01T00:00:00.000000+00:00',
+                updated_at='2024-01-01T00:00:00.000000+00:00',
+            )
+            self.lastId += 1
+            self.visualizations[self.lastId] = dict(
+                id=self.lastId, query_id=id, type='TABLE', name='Table',
+                description='', options={},
+            )
+            return 200, self.query(id)
+        match = re.match(r'api/queries/(\d+)$', path)
+        if match and int(match.group(1)) in self.queries:
+            query = self.queries[int(match.group(1))]
+            if data.pop('version', query['version']) != query['version']:
+                return 409, dict(message="Changes not saved, the query was modified")
+            query.update(data)
+            self._touch(query)
+            return 200, self.query(query['id'])
+
+        if path == 'api/visualizations':
+            self.lastId += 1
+            self.visualizations[self.lastId] = dict(data, id=self.lastId)
+            return 200, self.visualizations[self.lastId]
+        match = re.match(r'api/visualizations/(\d+)$', path)
+        if match and int(match.group(1)) in self.visualizations:
+            visualization = self.visualizations[int(match.group(1))]
+            visualization.update(data)
+            return 200, visualization
+
+        if path == 'api/dashboards':
+            self.lastId += 1
+            id = self.lastId
+            self.dashboards[id] = dict(
+                id=id, name=data['name'], slug='dashboard-{}'.format(id),
+                tags=[], version=1, is_archived=False, is_draft=True,
+                dashboard_filters_enabled=False,
+            )
+            return 200, self.dashboard(str(id))
+        match = re.match(r'api/dashboards/(\d+)$', path)
+        if match and int(match.group(1)) in self.dashboards:
+            dashboard = self.dashboards[int(match.group(1))]
+            if data.pop('version', dashboard['version']) != dashboard['version']:
+                return 409, dict(message="Changes not saved, the dashboard was modified")
+            dashboard.update(data)
+            self._touch(dashboard)
+            return 200, self.dashboard(str(dashboard['id']))
+
+        if path == 'api/widgets':
+            self.lastId += 1
+            self.widgets[self.lastId] = dict(data, id=self.lastId)
+            return 200, self.widgets[self.lastId]
+        match = re.match(r'api/widgets/(\d+)$', path)
+        if match and int(match.group(1)) in self.widgets:
+            widget = self.widgets[int(match.group(1))]
+            widget.update(data)
+            return 200, widget
+        return 404, dict(message="Couldn't find resource")
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body together, avoiding delayed ack stalls
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    redash = None # set by serve()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, content):
+        body = json.dumps(content).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            # Clients may stop reading a long result
+            self.close_connection = True
+        with self.redash.lock:
+            self.redash.stats['requests'] += 1
+            self.redash.stats['bytes'] += len(body)
+
+    def do_GET(self):
+        time.sleep(self.redash.latency)
+        url = urlparse(self.path)
+        with self.redash.lock:
+            status, content = self.redash.get(url.path.strip('/'), parse_qs(url.query))
+        self._reply(status, content)
+
+    def do_POST(self):
+        time.sleep(self.redash.latency)
+        length = int(self.headers.get('Content-Length', 0))
+        data = json.loads(self.rfile.read(length) or b'{}')
+        status, content = self.redash.post(urlparse(self.path).path.strip('/'), data)
+        self._reply(status, content)
+
+
+class Server(ThreadingHTTPServer):
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def serve(redash, port=0):
+    """Serves the fake instance in a background thread.
+    Returns the server, its url is in server.url.
+    """
+    handler = type('Handler', (Handler,), dict(redash=redash))
+    server = Server(('127.0.0.1', port), handler)
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--dashboards', type=int, default=10)
+    parser.add_argument('--widgets', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0,
+        help="seconds added to every request")
+    args = parser.parse_args()
+    redash = FakeRedash(latency=args.latency).generate(
+        queries=args.queries,
+        dashboards=args.dashboards,
+        widgets=args.widgets,
+        seed=args.seed,
+    )
+    server = serve(redash, args.port)
+    print("Serving a fake Redash at {}".format(server.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+End to end benchmark of redasher against a local fake Redash.
+
+For every size it runs, in a fresh directory,
+a full `checkout-all`, an incremental re-checkout,
+a `sync` of every dashboard and query to a second server,
+without files, and an upload of them all to a third one,
+reporting wall time, requests, bytes received and peak RSS.
+
+    python benchmarks/run.py --sizes 100,1000 --latency 0.01 --jobs 8
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+from fakeredash import FakeRedash, serve
+
+packagePath = Path(__file__).absolute().parent.parent
+
+
+def redasher(workdir, *args):
+    """Runs redasher in workdir returning (seconds, peak rss in KB)"""
+    env = dict(os.environ,
+        PYTHONPATH=os.pathsep.join(
+            [str(packagePath)] + os.environ.get('PYTHONPATH', '').split(os.pathsep)
+        ),
+    )
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'redasher_ja.cli'] + [str(arg) for arg in args],
+        cwd=str(workdir),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - start
+    if process.returncode:
+        sys.stderr.write(stderr.decode('utf8', 'replace'))
+        raise RuntimeError("redasher {} failed".format(' '.join(map(str, args))))
+    maxrss = usage.ru_maxrss # KB in Linux
+    if sys.platform == 'darwin':
+        maxrss //= 1024
+    return elapsed, maxrss
+
+
+def measure(redash, workdir, name, *args):
+    before = dict(redash.stats)
+    elapsed, maxrss = redasher(workdir, *args)
+    return dict(
+        scenario=name,
+        seconds=elapsed,
+        requests=redash.stats['requests'] - before.get('requests', 0),
+        bytes=redash.stats['bytes'] - before.get('bytes', 0),
+        maxrss=maxrss,
+    )
+
+
+def benchmark(size, dashboards, widgets, latency, jobs, seed):
+    redash = FakeRedash(latency=latency).generate(
+        queries=size,
+        dashboards=dashboards,
+        widgets=widgets,
+        seed=seed,
+    )
+    server = serve(redash)
+    try:
+        with tempfile.TemporaryDirectory(prefix='redasher-bench-') as workdir:
+            workdir = Path(workdir)
+            redasher(workdir, 'setup', 'bench', server.url, 'apikey')
+            redasher(workdir, 'setup', 'target', server.url, 'apikey')
+            redasher(workdir, 'setup', 'synced', server.url, 'apikey')
+            results = [
+                measure(redash, workdir, 'checkout-all',
+                    'checkout-all', 'bench', '--jobs', jobs),
+                measure(redash, workdir, 'incremental',
+                    'checkout-all', 'bench', '--jobs', jobs, '--incremental'),
+            ]
+            for datasource in sorted((workdir/'datasources').iterdir()):
+                id = boundId(workdir, 'bench', datasource)
+                for target in ('target', 'synced'):
+                    redasher(workdir, 'bind', target, 'datasource',
+                        datasource.relative_to(workdir), id)
+            objects = sorted(
+                str(path.relative_to(workdir))
+                for path in list((workdir/'dashboards').iterdir())
+                    + list((workdir/'queries').iterdir())
+            )
+            # Before uploading, which adds copies to sync
+            results.append(measure(redash, workdir, 'sync',
+                'sync', 'bench', 'synced', '--jobs', jobs))
+            results.append(measure(redash, workdir, 'upload',
+                'upload', 'target', '--jobs', jobs, *objects))
+            return results
+    finally:
+        server.shutdown()
+
+
+def boundId(workdir, servername, path):
+    "Id bound to path in the server map"
+    sys.path.insert(0, str(packagePath))
+    from yamlns import namespace as ns
+    maps = ns.load(str(workdir/'maps'/'{}.yaml'.format(servername)))
+    relative = str(path.relative_to(workdir))
+    for id, bound in maps.datasource.items():
+        if bound == relative:
+            return id
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000',
+        help="comma separated numbers of queries")
+    parser.add_argument('--dashboards', type=float, default=0.1,
+        help="dashboards per query")
+    parser.add_argument('--widgets', type=int, default=6,
+        help="widgets per dashboard")
+    parser.add_argument('--latency', type=float, default=0.0,
+        help="seconds added by the server to every request")
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    header = "{:>8} {:<14} {:>9} {:>9} {:>12} {:>10}".format(
+        'queries', 'scenario', 'seconds', 'requests', 'bytes', 'peak MB')
+    print(header)
+    print('-'*len(header))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        results = benchmark(size,
+            dashboards=max(1, int(size*args.dashboards)),
+            widgets=args.widgets,
+            latency=args.latency,
+            jobs=args.jobs,
+            seed=args.seed,
+        )
+        for result in results:
+            print("{:>8} {scenario:<14} {seconds:>9.2f} {requests:>9} {bytes:>12} {:>10.1f}".format(
+                size, result['maxrss']/1024., **result))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
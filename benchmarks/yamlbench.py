@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the YAML serialization, yamlns against redasher's.
+
+Dumps and loads generated visualizations with large options,
+query metadata and a map file, checking that both
+produce the same text and the same objects.
+
+    python benchmarks/yamlbench.py --count 500 --series 40
+"""
+
+import sys
+import time
+import random
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from yamlns import namespace as ns
+from redasher_ja.serialization import dumpYaml, loadsYaml, fast
+
+
+def visualization(rnd, id, series):
+    return ns(
+        id=id,
+        name=rnd.choice(['Chart', 'グラフ', 'Untitled']),
+        description='',
+        type='CHART',
+        options=ns(
+            globalSeriesType=rnd.choice(['line', 'column', 'pie']),
+            columnMapping={'day': 'x', 'count': 'y', 'total': 'y'},
+            seriesOptions={
+                'series{}'.format(s): dict(
+                    color='#{:06x}'.format(rnd.getrandbits(24)),
+                    type='line',
+                    yAxis=s % 2,
+                    zIndex=s,
+                    index=0,
+                    name='系列 {}'.format(s),
+                )
+                for s in range(series)
+            },
+            xAxis=dict(type='-', labels=dict(enabled=True)),
+            yAxis=[dict(type='linear'), dict(type='linear', opposite=True)],
+            numberFormat='0,0[.]00000',
+            percentFormat='0[.]00%',
+            legend=dict(enabled=True, placement='auto'),
+            sortX=True,
+            missingValuesAsZero=True,
+        ),
+        updated_at='2023-01-01T00:00:00.000000+00:00',
+    )
+
+def query(rnd, id):
+    return ns(
+        id=id,
+        name='Query {}'.format(id),
+        description=None,
+        query='SELECT day, count(*)\nFROM table_{}\nGROUP BY day\n'.format(id),
+        data_source_id='datasources/postgres.yaml',
+        schedule=None,
+        options=ns(parameters=[
+            dict(name='since', title='Since', type='date', value='d_now'),
+        ]),
+        tags=rnd.sample(['sales', 'kpi', '集計', 'daily'], 2),
+        is_archived=False,
+        is_draft=False,
+        version=rnd.randint(1, 20),
+    )
+
+def mapfile(count):
+    return ns(
+        query=ns((id, 'queries/query-{}'.format(id)) for id in range(count)),
+        visualization=ns(
+            (id, 'queries/query-{}/visualizations/chart.yaml'.format(id))
+            for id in range(count)
+        ),
+    )
+
+def timed(function, items):
+    start = time.perf_counter()
+    results = [function(item) for item in items]
+    return time.perf_counter() - start, results
+
+def compare(name, documents):
+    yamlnsDump, texts = timed(lambda document: document.dump(), documents)
+    fastDump, fastTexts = timed(dumpYaml, documents)
+    yamlnsLoad, loaded = timed(ns.loads, texts)
+    fastLoad, fastLoaded = timed(loadsYaml, texts)
+    if fastTexts != texts or fastLoaded != loaded:
+        raise AssertionError("{}: output differs from yamlns".format(name))
+    size = sum(len(text.encode('utf8')) for text in texts)
+    for operation, reference, measured in [
+            ('dump', yamlnsDump, fastDump),
+            ('load', yamlnsLoad, fastLoad),
+            ]:
+        print("{:<16} {:<5} {:>10} {:>9.3f} {:>9.3f} {:>7.1f}x".format(
+            name, operation, size, reference, measured, reference/measured))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=500,
+        help="number of documents of each kind")
+    parser.add_argument('--series', type=int, default=40,
+        help="series in the options of each visualization")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not fast:
+        print("libyaml not available, both use yamlns")
+    rnd = random.Random(args.seed)
+    header = "{:<16} {:<5} {:>10} {:>9} {:>9} {:>8}".format(
+        'document', 'op', 'bytes', 'yamlns s', 'fast s', 'speedup')
+    print(header)
+    print('-'*len(header))
+    compare('visualization', [
+        visualization(rnd, id, args.series) for id in range(args.count)])
+    compare('query', [query(rnd, id) for id in range(args.count)])
+    compare('map', [mapfile(args.count * 20)])
+
+
+if __name__ == '__main__':
+    main()
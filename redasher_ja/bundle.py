@@ -0,0 +1,141 @@
+# Single file bundles of file objects and maps
+
+import os
+import json
+import mmap
+import zlib
+import struct
+from pathlib import Path
+from consolemsg import fail
+from .tree import NameIndex
+from .serialization import loadsYaml
+
+# Layout: header, the zlib stream of every file one after another,
+# the zlib compressed json table {path: [offset, length, size]},
+# and a trailer with the offset and length of that table.
+_magic = b'RDSHBNDL'
+_header = struct.Struct('<8sI')
+_trailer = struct.Struct('<QQ8s')
+version = 1
+
+class BundleWriter(object):
+    """Writes a bundle file by file, sequentially, never seeking back,
+    into a temporary sibling renamed over `filename` on close.
+    Use it as a context manager to discard it on errors.
+    """
+    def __init__(self, filename, chunksize=1024*1024):
+        self.filename = Path(filename)
+        self.chunksize = chunksize
+        self.tmpfile = self.filename.with_name('.{}.tmp'.format(self.filename.name))
+        self.output = self.tmpfile.open('wb')
+        self.offset = 0
+        self.table = {}
+        self._write(_header.pack(_magic, version))
+
+    def _write(self, data):
+        self.output.write(data)
+        self.offset += len(data)
+
+    def _add(self, path, chunks):
+        path = Path(path).as_posix()
+        if path in self.table:
+            raise ValueError("{} already in the bundle".format(path))
+        compressor = zlib.compressobj()
+        start = self.offset
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            self._write(compressor.compress(chunk))
+        self._write(compressor.flush())
+        self.table[path] = [start, self.offset - start, size]
+
+    def add(self, path, content):
+        "Adds a file at path with content, bytes or text as utf8"
+        if isinstance(content, str):
+            content = content.encode('utf8')
+        self._add(path, [content])
+
+    def addFile(self, path, filename):
+        "Adds at path the content of filename, read in chunks"
+        with open(str(filename), 'rb') as input:
+            self._add(path, iter(lambda: input.read(self.chunksize), b''))
+
+    def close(self):
+        "Writes the table and puts the bundle in place"
+        table = zlib.compress(json.dumps(self.table,
+            ensure_ascii=False, separators=(',', ':')).encode('utf8'))
+        tableoffset = self.offset
+        self._write(table)
+        self._write(_trailer.pack(tableoffset, len(table), _magic))
+        self.output.close()
+        os.replace(str(self.tmpfile), str(self.filename))
+
+    def discard(self):
+        self.output.close()
+        if self.tmpfile.exists():
+            self.tmpfile.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.discard()
+
+class BundleTree(NameIndex):
+    """File objects read from a bundle, in place:
+    the table is read on open and every file is decompressed
+    from its offset just when asked for.
+    """
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        try:
+            with self.filename.open('rb') as input:
+                self.data = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            fail("Bundle {} not found".format(self.filename))
+        except ValueError: # empty file
+            self.data = b''
+        if len(self.data) < _header.size + _trailer.size:
+            fail("{} is not a bundle".format(self.filename))
+        magic, bundleversion = _header.unpack_from(self.data, 0)
+        tableoffset, tablelength, trailermagic = _trailer.unpack_from(
+            self.data, len(self.data) - _trailer.size)
+        if magic != _magic or trailermagic != _magic:
+            fail("{} is not a bundle".format(self.filename))
+        if bundleversion != version:
+            fail("Bundle {} has version {}, expected {}".format(
+                self.filename, bundleversion, version))
+        self.table = json.loads(zlib.decompress(
+            self.data[tableoffset:tableoffset + tablelength]).decode('utf8'))
+        self._children = {}
+        for path in self.table:
+            self._addName(path)
+
+    def paths(self):
+        "Paths of the bundled files, in the order they were added"
+        return list(self.table)
+
+    def exists(self, path):
+        return Path(path).as_posix() in self.table
+
+    def _entry(self, path):
+        try:
+            return self.table[Path(path).as_posix()]
+        except KeyError:
+            fail("No file {} in bundle {}".format(path, self.filename))
+
+    def bytes(self, path):
+        "Content of a file"
+        offset, length, size = self._entry(path)
+        return zlib.decompress(self.data[offset:offset + length])
+
+    def load(self, path):
+        "Content of a YAML file"
+        return loadsYaml(self.read(path))
+
+    def read(self, path):
+        "Text of a file"
+        return self.bytes(path).decode('utf8')
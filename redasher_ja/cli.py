@@ -4,17 +4,27 @@ import click
 from pathlib import Path
 from yamlns import namespace as ns
 from consolemsg import out, warn, step, fail
-from .redash import Redash
-from .mapper import Mapper
+from .mapper import createMapper
 from . import __version__
+from .trace import startTracing, stopTracing
 from .repo import (
     serverConfig,
     setServerConfig,
+    connect,
     defaultServer,
     setDefaultServer,
     checkoutAll,
     checkoutQuery,
+    checkoutDashboard,
+    syncServers,
+    Selector,
     uploadFile,
+    watchUploads,
+    planUpload,
+    exportBundle,
+    importBundle,
+    repoIndex,
+    objectPath,
 )
 
 
@@ -22,13 +32,21 @@ from .repo import (
 @click.group()
 @click.help_option()
 @click.version_option(__version__)
-def cli():
+@click.option("--trace", type=click.Path(dir_okay=False), metavar="FILE",
+    help="Records timed spans of requests, files, maps and slugs into FILE")
+@click.option("--trace-format", type=click.Choice(['jsonl', 'chrome']),
+    help="Json lines, or Chrome trace format. Default: chrome for .json files")
+@click.pass_context
+def cli(ctx, trace, trace_format):
     'Manages a git controlled and file based version of Redash dashboards'
+    if not trace: return
+    startTracing(trace, trace_format)
+    ctx.call_on_close(lambda: step(stopTracing()))
 
 @cli.command('list')
 def _list():
     config = serverConfig()
-    redash = Redash(config.url, config.apikey)
+    redash = connect(config)
     for dashboard in redash.dashboards():
         dashboard = ns(dashboard)
         out("{}: {} \"{}\"", dashboard.id, dashboard.slug, dashboard.name)
@@ -37,7 +55,7 @@ def _list():
 @click.argument('id')
 def pull(id):
     config = serverConfig()
-    redash = Redash(config.url, config.apikey)
+    redash = connect(config)
     dashboard = ns(redash.dashboard(id))
     dashboard.dump("{}.yaml".format(dashboard.slug))
     click.echo(dashboard.dump())
@@ -46,7 +64,7 @@ def pull(id):
 @cli.command()
 def qlist():
     config = serverConfig()
-    redash = Redash(config.url, config.apikey)
+    redash = connect(config)
     for query in redash.queries():
         query = ns(query)
         print(query.dump())
@@ -55,7 +73,7 @@ def qlist():
 @cli.command()
 def ulist():
     config = serverConfig()
-    redash = Redash(config.url, config.apikey)
+    redash = connect(config)
     for user in redash.users():
         user = ns(user)
         out("{}: \"{}\"", user.id, user.name)
@@ -65,16 +83,39 @@ def ulist():
 def qpull(id):
     """Retrieve a query"""
     config = serverConfig()
-    redash = Redash(config.url, config.apikey)
+    redash = connect(config)
     query = ns(redash.query(id))
     #query.dump("{}.yaml".format(query.slug))
     click.echo(query.dump())
 
+def _timeout(ctx, param, value):
+    "Seconds, or connect and read seconds separated by a comma"
+    if value is None:
+        return None
+    try:
+        seconds = [float(part) for part in value.split(',')]
+        seconds = [int(part) if part.is_integer() else part for part in seconds]
+    except ValueError:
+        seconds = []
+    if len(seconds) not in (1, 2):
+        raise click.BadParameter("expected SECONDS or CONNECT,READ seconds")
+    return seconds[0] if len(seconds) == 1 else seconds
+
 @cli.command()
 @click.argument("servername")
 @click.argument("url")
 @click.argument("apikey")
-def setup(servername, url, apikey):
+@click.option("--poolsize", type=int,
+    help="Connections kept to the server. Default: enough for the concurrent requests")
+@click.option("--timeout", callback=_timeout, metavar="SECONDS[,SECONDS]",
+    help="Request timeout, or connect and read timeouts. Default: 10,120")
+@click.option("--keepalive/--no-keepalive", default=None,
+    help="Reuse connections between requests. Default: reuse")
+@click.option("--compression/--no-compression", default=None,
+    help="Ask for gzip compressed responses. Default: ask")
+@click.option("--proxy/--no-proxy", default=None,
+    help="Use the proxies in the environment. Default: use")
+def setup(servername, url, apikey, poolsize, timeout, keepalive, compression, proxy):
     """Configures a Redash server to work with.
 
     SERVERNAME is the name setup for the server.
@@ -82,10 +123,19 @@ def setup(servername, url, apikey):
     APIKEY is the validation key related to the user
     the program is going to act in behalf on.
 
+    The transport options given are also kept,
+    along with any other setting the server already had.
+
     If no default server has been configured this
     server will be considered default.
     """
-    setServerConfig(servername, url, apikey)
+    setServerConfig(servername, url, apikey,
+        poolsize=poolsize,
+        timeout=timeout,
+        keepalive=keepalive,
+        compression=compression,
+        noproxy=None if proxy is None else not proxy,
+    )
 
 @cli.command()
 @click.argument("servername", required=False)
@@ -110,36 +160,255 @@ def default(servername=None):
 @click.argument("id", type=int)
 def bind(servername, type, id, file):
     """Relates a file object FILE to an ID of type TYPE in SERVER"""
-    configfile = serverConfig(servername)
+    config = serverConfig(servername)
     repopath = Path('.')
-    mapper = Mapper(repopath, servername)
+    mapper = createMapper(repopath, config)
     oldfile = mapper.get(type, id)
     if oldfile:
         warn("Id {} in {} was bound to {}".format(
             id, servername, oldfile
         ))
     mapper.bind(type, id, file)
+    mapper.flush()
+
+@cli.command()
+@click.argument("servername")
+def map_import(servername):
+    """Loads maps/SERVERNAME.yaml into the server map store"""
+    config = serverConfig(servername)
+    mapper = createMapper(Path('.'), config)
+    if not mapper.mapfile.exists():
+        fail("No map file {} to import".format(mapper.mapfile))
+    mapper.importYaml()
+
+@cli.command()
+@click.argument("servername")
+def map_export(servername):
+    """Writes the server map store into maps/SERVERNAME.yaml"""
+    config = serverConfig(servername)
+    mapper = createMapper(Path('.'), config)
+    mapper.exportYaml()
+
+
+def _resultsOptions(command):
+    "Adds the options to download query results to a checkout command"
+    command = click.option("--with-results", "withresults", is_flag=True,
+        help="Download also the latest results of the queries")(command)
+    command = click.option("--results-max-size", "resultsmaxsize", type=float,
+        default=10, show_default=True,
+        help="Maximum MB of results downloaded per query")(command)
+    return command
+
+def _selectorOptions(command):
+    "Adds the options selecting queries and dashboards to a command"
+    for option in reversed([
+        click.option("--tag", "tags", multiple=True,
+            help="Just queries and dashboards having this tag (repeat for any of several)"),
+        click.option("--since", type=click.DateTime(),
+            help="Just queries and dashboards updated since this date (UTC)"),
+        click.option("--query-ids", "queryids", type=str,
+            help="Just queries with those comma separated ids"),
+        click.option("--dashboard-ids", "dashboardids", type=str,
+            help="Just dashboards with those comma separated ids"),
+        click.option("--name-glob",
+            help="Just queries and dashboards whose name matches this glob pattern"),
+    ]):
+        command = option(command)
+    return command
 
+def _idList(option, ids):
+    try:
+        return [int(id) for id in ids.split(',')] if ids else []
+    except ValueError:
+        fail("{} should be a comma separated list of numbers".format(option))
+
+def _selector(tags, since, queryids, dashboardids, name_glob):
+    return Selector(tags=tags, since=since,
+        queryIds=_idList('--query-ids', queryids),
+        dashboardIds=_idList('--dashboard-ids', dashboardids),
+        nameglob=name_glob,
+    )
 
 @cli.command()
 @click.argument("servername")
-def checkout_all(servername):
-    """Downloads all objects from a Redash server"""
-    checkoutAll(servername)
+@click.option("--jobs", "-j", type=int, default=1, show_default=True,
+    help="Number of objects fetched concurrently")
+@click.option("--incremental", is_flag=True,
+    help="Skip queries and dashboards not updated since the last checkout. "
+        "Changes to just their visualizations or widgets are missed, "
+        "run a full checkout from time to time to get them")
+@_selectorOptions
+@click.option("--only", type=click.Choice(['queries', 'dashboards']),
+    help="Just check out data sources and these objects")
+@_resultsOptions
+@click.option("--git-commit", "gitcommit", is_flag=True,
+    help="Commit the files to git instead of writing them")
+@click.option("--git-branch", "gitbranch",
+    help="Branch to commit to with --git-commit, the current one by default")
+def checkout_all(servername, jobs, incremental, tags, since, queryids, dashboardids, name_glob, only,
+        withresults, resultsmaxsize, gitcommit, gitbranch):
+    """Downloads all objects from a Redash server
+
+    The selection options limit the queries and dashboards checked out.
+    When several are given, objects must match all of them.
+
+    With --git-commit, the objects go into a new commit
+    without writing their files into the working tree.
+    """
+    checkoutAll(servername,
+        jobs=jobs,
+        incremental=incremental,
+        selector=_selector(tags, since, queryids, dashboardids, name_glob),
+        only=only,
+        withResults=withresults,
+        resultsMaxSize=int(resultsmaxsize*1024*1024),
+        gitCommit=gitcommit,
+        gitBranch=gitbranch,
+    )
    
 @cli.command()
 @click.argument("servername")
 @click.argument("queryid")
-def checkout_query(servername, queryid):
+@_resultsOptions
+def checkout_query(servername, queryid, withresults, resultsmaxsize):
     """Donwloads a query from a Redash server"""
-    checkoutQuery(servername, queryid)
+    checkoutQuery(servername, queryid,
+        withResults=withresults,
+        resultsMaxSize=int(resultsmaxsize*1024*1024),
+    )
+
+@cli.command()
+@click.argument("servername")
+@click.argument("dashboard")
+@click.option("--jobs", "-j", type=int, default=1, show_default=True,
+    help="Number of objects fetched concurrently")
+@_resultsOptions
+def checkout_dashboard(servername, dashboard, jobs, withresults, resultsmaxsize):
+    """Downloads a dashboard, given its id or slug, with
+    the queries, parameter queries and data sources it uses"""
+    checkoutDashboard(servername, dashboard,
+        jobs=jobs,
+        withResults=withresults,
+        resultsMaxSize=int(resultsmaxsize*1024*1024),
+    )
 
 @cli.command()
 @click.argument("servername")
 @click.argument("objectfile", type=Path, nargs=-1)
-def upload(servername, objectfile):
+@click.option("--force", is_flag=True,
+    help="Upload even the objects not changed since their last upload")
+@click.option("--jobs", "-j", type=int, default=1, show_default=True,
+    help="Number of objects uploaded concurrently")
+@click.option("--from-plan", "fromplan", is_flag=True,
+    help="Compare with the server objects first and send just the changed fields")
+@click.option("--affected-by", "affectedby", type=Path, multiple=True,
+    help="Upload also this object and every object using it")
+@click.option("--bundle", type=click.Path(exists=True, dir_okay=False),
+    help="Read the objects from this bundle instead of the working directory")
+def upload(servername, objectfile, force, jobs, fromplan, affectedby, bundle):
     "Upload a dashboard and all dependant objects"
-    uploadFile(servername, *objectfile)
+    uploadFile(servername, *objectfile,
+        force=force,
+        jobs=jobs,
+        fromPlan=fromplan,
+        affectedBy=affectedby,
+        bundle=bundle,
+    )
+
+@cli.command()
+@click.argument("source")
+@click.argument("target")
+@click.option("--jobs", "-j", type=int, default=1, show_default=True,
+    help="Number of objects fetched, and uploaded, concurrently")
+@_selectorOptions
+@click.option("--checkout", is_flag=True,
+    help="Write also the objects into the working directory, at the end")
+def sync(source, target, jobs, tags, since, queryids, dashboardids, name_glob, checkout):
+    """Copies objects from the SOURCE server to the TARGET one
+
+    Selected queries and dashboards, all if no selection option is given,
+    and the queries they use, are uploaded while being fetched,
+    without writing them to files unless --checkout.
+    """
+    syncServers(source, target,
+        selector=_selector(tags, since, queryids, dashboardids, name_glob),
+        jobs=jobs,
+        checkout=checkout,
+    )
+
+@cli.command()
+@click.argument("servername")
+@click.argument("path", type=Path, nargs=-1)
+@click.option("--jobs", "-j", type=int, default=1, show_default=True,
+    help="Number of objects uploaded concurrently")
+@click.option("--interval", type=float, default=0.2, show_default=True,
+    help="Seconds between looks for changes, when polling")
+@click.option("--debounce", type=float, default=0.3, show_default=True,
+    help="Seconds without further changes to wait before uploading")
+def watch(servername, path, jobs, interval, debounce):
+    """Uploads the objects changed under PATH, queries and dashboards by default
+
+    Changed objects are uploaded with the objects they require,
+    but not the ones they contain, unless they are new.
+    """
+    watchUploads(servername, *path,
+        jobs=jobs,
+        interval=interval,
+        debounce=debounce,
+    )
+
+@cli.command()
+@click.argument("servername")
+@click.argument("objectfile", type=Path, nargs=-1)
+@click.option("--jobs", "-j", type=int, default=1, show_default=True,
+    help="Number of objects fetched concurrently")
+@click.option("--bundle", type=click.Path(exists=True, dir_okay=False),
+    help="Read the objects from this bundle instead of the working directory")
+def plan(servername, objectfile, jobs, bundle):
+    "Show the fields an upload would change in the server"
+    planUpload(servername, *objectfile, jobs=jobs, bundle=bundle)
+
+@cli.group()
+def bundle():
+    "Packs file objects and maps into a single file, and back"
+
+@bundle.command('export')
+@click.argument("bundlefile", type=Path)
+@click.argument("path", type=Path, nargs=-1)
+def bundle_export(bundlefile, path):
+    """Packs the files under PATH into BUNDLEFILE
+
+    By default, data sources, queries, dashboards and maps.
+    """
+    exportBundle(bundlefile, *path)
+
+@bundle.command('import')
+@click.argument("bundlefile", type=click.Path(exists=True, dir_okay=False))
+@click.argument("path", type=Path, nargs=-1)
+def bundle_import(bundlefile, path):
+    """Writes the files in BUNDLEFILE into the working directory
+
+    Just the ones under PATH, if given. Unchanged files are not rewritten.
+    """
+    importBundle(bundlefile, *path)
+
+def _printObjects(index, objects):
+    for path in sorted(objects):
+        out("{} {}", index.types.get(path, '?'), path)
+
+@cli.command()
+@click.argument("objectfile", type=Path, nargs=-1, required=True)
+def deps(objectfile):
+    "List the file objects the given ones use, directly or not"
+    index = repoIndex()
+    _printObjects(index, index.dependencies(*map(objectPath, objectfile)))
+
+@cli.command()
+@click.argument("objectfile", type=Path, nargs=-1, required=True)
+def rdeps(objectfile):
+    "List the file objects using the given ones, directly or not"
+    index = repoIndex()
+    _printObjects(index, index.dependants(*map(objectPath, objectfile)))
 
 
 
@@ -0,0 +1,47 @@
+# Safe file writing helpers
+
+import os
+import json
+
+def atomicWrite(filename, content):
+    """Writes content (bytes or text, as utf8) into a sibling
+    temporary file and renames it over filename, so readers
+    never see a truncated file.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf8')
+    filename.parent.mkdir(exist_ok=True, parents=True)
+    tmpfile = filename.with_name('.{}.tmp'.format(filename.name))
+    tmpfile.write_bytes(content)
+    os.replace(str(tmpfile), str(filename))
+
+def sameContent(filename, content):
+    "Whether filename already holds exactly content (bytes)"
+    try:
+        if filename.stat().st_size != len(content):
+            return False
+    except FileNotFoundError:
+        return False
+    return filename.read_bytes() == content
+
+def writeIfChanged(filename, content):
+    """Atomically writes content (bytes or text, as utf8)
+    unless filename already has it, keeping its mtime.
+    Returns whether the file was written.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf8')
+    if sameContent(filename, content):
+        return False
+    atomicWrite(filename, content)
+    return True
+
+def loadJson(filename):
+    "Loads a json cache file, an empty dict if missing"
+    if not filename.exists():
+        return {}
+    return json.loads(filename.read_text(encoding='utf8'))
+
+def dumpJson(filename, data):
+    "Atomically writes a json cache file"
+    atomicWrite(filename, json.dumps(data, ensure_ascii=False, sort_keys=True))
@@ -0,0 +1,176 @@
+# Committing files straight into the git object database
+
+import hashlib
+import subprocess
+from pathlib import Path
+from consolemsg import fail
+
+def _blobId(content):
+    "The id git gives to a blob with that content"
+    return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+def _quote(path):
+    "Path as fast-import reads it, quoted if needed"
+    if not path.startswith('"') and '\n' not in path:
+        return path
+    return '"{}"'.format(path
+        .replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n'))
+
+class GitCommit(object):
+    """Builds a commit on top of a branch, the current one by default,
+    streaming the files given to `git fast-import`,
+    without reading or writing the working tree.
+
+    Files not given keep the content they have in the branch,
+    and the ones given with the same content are not even sent.
+    The branch starts at HEAD if it does not exist yet.
+    When it is the current branch, the index entries of the committed
+    files are moved along, other entries, staged or not, are kept,
+    and the working tree is left as it was.
+    Paths are relative to repopath, which may be within the repository.
+    """
+    def __init__(self, repopath='.', branch=None):
+        self.repopath = Path(repopath)
+        self.prefix = self._git('rev-parse', '--show-prefix').strip()
+        current = self._git('symbolic-ref', '-q', '--short', 'HEAD', check=False).strip()
+        if not branch and not current:
+            fail("HEAD is detached, choose a branch to commit to")
+        self.branch = branch or current
+        self.current = self.branch == current
+        self.ref = 'refs/heads/' + self.branch
+        self.parent = self._git('rev-parse', '-q', '--verify', self.ref + '^{commit}', check=False).strip()
+        self.created = not self.parent
+        if self.created:
+            self.parent = self._git('rev-parse', '-q', '--verify', 'HEAD^{commit}', check=False).strip()
+        self.parent = self.parent or None
+        # Resolved before streaming anything, it fails without an identity
+        self.author = self._git('var', 'GIT_AUTHOR_IDENT').strip()
+        self.committer = self._git('var', 'GIT_COMMITTER_IDENT').strip()
+        self.blobs = {}
+        if self.parent:
+            listing = self._git('ls-tree', '-r', '-z', self.parent)
+            for entry in listing.split('\0'):
+                if not entry: continue
+                info, path = entry.split('\t', 1)
+                mode, type, id = info.split()
+                if type == 'blob':
+                    self.blobs[path] = (mode, id)
+        self._names = None
+        self.files = {}
+        self.marks = 0
+        self.process = None
+        self.midstream = False
+
+    def _git(self, *args, check=True, input=None):
+        try:
+            result = subprocess.run(['git'] + list(args),
+                cwd=str(self.repopath),
+                input=input,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            fail("git is not installed")
+        if check and result.returncode:
+            fail("git {} failed: {}".format(args[0],
+                result.stderr.decode('utf8', 'replace').strip()))
+        return result.stdout.decode('utf8')
+
+    def exists(self, path):
+        "Whether the file is in the branch or has been added"
+        return str(path) in self.files or str(path) in self.blobs
+
+    def names(self, directory):
+        "Names of the files and folders in directory, in the branch"
+        if self._names is None:
+            self._names = {}
+            for path in self.blobs:
+                path = Path(path)
+                for parent in path.parents:
+                    self._names.setdefault(str(parent), set()).add(path.name)
+                    path = parent
+        return set(self._names.get(str(Path(directory)), ()))
+
+    def _send(self, *chunks):
+        if self.process is None:
+            self.process = subprocess.Popen(
+                ['git', 'fast-import', '--quiet', '--done'],
+                cwd=str(self.repopath),
+                stdin=subprocess.PIPE,
+            )
+        # Set while a command is half written, so abort() does not end it
+        self.midstream = True
+        for chunk in chunks:
+            self.process.stdin.write(chunk.encode('utf8') if isinstance(chunk, str) else chunk)
+        self.midstream = False
+
+    def add(self, path, content):
+        """Adds the file with content (bytes or text, as utf8) to the commit.
+        Returns whether it differs from the one in the branch.
+        """
+        if isinstance(content, str):
+            content = content.encode('utf8')
+        path = str(path)
+        blobId = _blobId(content)
+        if self.blobs.get(path) == ('100644', blobId):
+            self.files.pop(path, None)
+            return False
+        self.marks += 1
+        mark = self.marks
+        self._send('blob\nmark :{}\ndata {}\n'.format(mark, len(content)), content, '\n')
+        self.files[path] = (mark, blobId)
+        return True
+
+    def commit(self, message):
+        """Commits the added files, if any changed.
+        Returns the new commit id or None.
+        """
+        if not self.files:
+            self.abort()
+            if self.created and self.parent:
+                self._git('update-ref', self.ref, self.parent)
+            return None
+        message = message.encode('utf8')
+        self._send(
+            'commit {}\n'.format(self.ref),
+            'author {}\n'.format(self.author),
+            'committer {}\n'.format(self.committer),
+            'data {}\n'.format(len(message)), message, '\n',
+            'from {}\n'.format(self.parent) if self.parent else '',
+        )
+        for path, (mark, blobId) in sorted(self.files.items()):
+            self._send('M 100644 :{} {}\n'.format(mark, _quote(self.prefix + path)))
+        self._send('\n')
+        self._finish()
+        if self.current:
+            self._git('update-index', '-z', '--index-info', input=''.join(
+                '100644 {}\t{}\0'.format(blobId, self.prefix + path)
+                for path, (mark, blobId) in sorted(self.files.items())
+            ).encode('utf8'))
+        return self._git('rev-parse', self.ref).strip()
+
+    def abort(self):
+        "Ends without committing"
+        self.files = {}
+        if self.midstream and self.process is not None:
+            # Ending a half written command would just crash fast-import
+            process, self.process = self.process, None
+            process.kill()
+            process.wait()
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+            return
+        self._finish()
+
+    def _finish(self):
+        if self.process is None:
+            return
+        process, self.process = self.process, None
+        process.stdin.write(b'done\n')
+        process.stdin.close()
+        if process.wait():
+            fail("git fast-import failed")
@@ -0,0 +1,136 @@
+# On disk caches of Redash responses
+
+import sqlite3
+import threading
+import time
+from .files import loadJson, dumpJson
+
+class ResponseCache(object):
+    """Keeps GET response bodies by url in a SQLite file.
+
+    Entries with an ETag or Last-Modified validator are revalidated
+    with a conditional request, the rest are served while younger
+    than `ttl` seconds. Least recently used entries are evicted
+    to keep the bodies under `maxsize` bytes.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            lastmodified TEXT,
+            stored REAL NOT NULL,
+            used REAL NOT NULL,
+            size INTEGER NOT NULL,
+            body BLOB NOT NULL
+        )
+    """
+
+    def __init__(self, dbfile, ttl=3600, maxsize=200*1024*1024):
+        self.dbfile = dbfile
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._db is not None:
+            return self._db
+        self.dbfile.parent.mkdir(exist_ok=True, parents=True)
+        self._db = sqlite3.connect(str(self.dbfile), check_same_thread=False)
+        self._db.execute(self.schema)
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        return self._db
+
+    def get(self, url):
+        """Returns (body, headers, fresh) for a cached url, or None.
+        headers are the conditional request headers to revalidate it.
+        fresh tells whether it can be used without revalidation.
+        """
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT etag, lastmodified, stored, body "
+                "FROM responses WHERE url=?", (url,)).fetchone()
+        if not row:
+            return None
+        etag, lastmodified, stored, body = row
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if lastmodified:
+            headers['If-Modified-Since'] = lastmodified
+        fresh = not headers and time.time() - stored < self.ttl
+        return body, headers, fresh
+
+    def touch(self, url):
+        "Marks an entry as just used and still valid"
+        now = time.time()
+        with self._lock:
+            db = self._connection()
+            db.execute(
+                "UPDATE responses SET used=?, stored=? WHERE url=?",
+                (now, now, url))
+            db.commit()
+
+    def store(self, url, response):
+        now = time.time()
+        body = response.content
+        with self._lock:
+            db = self._connection()
+            db.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(url, etag, lastmodified, stored, used, size, body) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    response.headers.get('ETag'),
+                    response.headers.get('Last-Modified'),
+                    now, now, len(body), body,
+                ))
+            self._evict(db)
+            db.commit()
+
+    def _evict(self, db):
+        total, = db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if total <= self.maxsize:
+            return
+        rows = db.execute("SELECT url, size FROM responses ORDER BY used")
+        stale = []
+        for url, size in rows:
+            if total <= self.maxsize: break
+            stale.append((url,))
+            total -= size
+        db.executemany("DELETE FROM responses WHERE url=?", stale)
+
+    def invalidate(self, prefix):
+        "Drops the entries whose url starts with prefix"
+        with self._lock:
+            db = self._connection()
+            db.execute(
+                "DELETE FROM responses WHERE substr(url, 1, ?) = ?",
+                (len(prefix), prefix))
+            db.commit()
+
+class VersionCache(object):
+    """Keeps the version of every server, by url, in a json file,
+    for `ttl` seconds since it was probed.
+    """
+    def __init__(self, cachefile, ttl=24*3600):
+        self.cachefile = cachefile
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        "The version probed for url, None if unknown or expired"
+        with self._lock:
+            entry = loadJson(self.cachefile).get(url)
+        if not entry or not 0 <= time.time() - entry['probed'] < self.ttl:
+            return None
+        return entry['version']
+
+    def store(self, url, version):
+        with self._lock:
+            versions = loadJson(self.cachefile)
+            versions[url] = dict(version=version, probed=time.time())
+            dumpJson(self.cachefile, versions)
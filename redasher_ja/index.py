@@ -0,0 +1,137 @@
+# Index of the file objects in a repository and their references
+
+import os
+from pathlib import Path
+from .files import loadJson, dumpJson
+from .trace import span
+from .serialization import loadYaml
+
+class RepoIndex(object):
+    """Knows every file object in the repository, its type
+    and the objects it uses:
+
+    - dashboards use their widgets
+    - widgets use their visualization
+    - visualizations use their query
+    - queries use their data source and their parameter queries
+
+    Objects are identified by the path used in the maps.
+    The index is cached in `cachefile` and, on load,
+    just the files whose mtime or size changed are parsed again.
+    """
+    version = 1
+
+    def __init__(self, repopath, cachefile):
+        self.repopath = Path(repopath)
+        self.cachefile = cachefile
+        self.types = {}
+        self.uses = {}
+        self._usedBy = None
+
+    def _files(self):
+        "Yields (object path, type, file) for every object file"
+        def entries(directory):
+            try:
+                return sorted(os.scandir(str(self.repopath/directory)), key=lambda e: e.name)
+            except FileNotFoundError:
+                return []
+
+        for entry in entries('datasources'):
+            if entry.name.endswith('.yaml'):
+                yield 'datasources/'+entry.name, 'datasource', entry
+        for parentdir, kind, childdir, childkind in [
+                ('queries', 'query', 'visualizations', 'visualization'),
+                ('dashboards', 'dashboard', 'widgets', 'widget'),
+                ]:
+            for parent in entries(parentdir):
+                if not parent.is_dir(): continue
+                objectpath = parentdir + '/' + parent.name
+                for entry in entries(objectpath):
+                    if entry.name == 'metadata.yaml':
+                        yield objectpath, kind, entry
+                for entry in entries(objectpath + '/' + childdir):
+                    if entry.name.endswith('.yaml'):
+                        yield objectpath + '/' + childdir + '/' + entry.name, childkind, entry
+
+    @staticmethod
+    def _references(objectpath, type, filename):
+        "Objects a file object uses, reading the file only if needed"
+        if type == 'visualization':
+            return [str(Path(objectpath).parent.parent)]
+        if type == 'widget':
+            widget = loadYaml(filename)
+            return [widget.visualization] if isinstance(widget.get('visualization'), str) else []
+        if type == 'query':
+            query = loadYaml(filename)
+            references = []
+            if isinstance(query.get('data_source_id'), str):
+                references.append(query.data_source_id)
+            for parameter in (query.get('options') or {}).get('parameters', []):
+                if isinstance(parameter.get('queryId'), str):
+                    references.append(parameter.queryId)
+            return references
+        return []
+
+    def load(self):
+        "Updates the index with the repository files, returns self"
+        cache = loadJson(self.cachefile)
+        if cache.get('version') != self.version:
+            cache = {}
+        cached = cache.get('files', {})
+        files = {}
+        parsed = 0
+        with span('index', 'files') as traced:
+            for objectpath, type, entry in self._files():
+                stat = entry.stat()
+                signature = [stat.st_mtime_ns, stat.st_size]
+                old = cached.get(entry.path)
+                if old and old['signature'] == signature:
+                    files[entry.path] = old
+                    continue
+                parsed += 1
+                files[entry.path] = dict(
+                    signature=signature,
+                    object=objectpath,
+                    type=type,
+                    uses=self._references(objectpath, type, entry.path),
+                )
+            traced.update(files=len(files), parsed=parsed)
+        if parsed or len(files) != len(cached):
+            dumpJson(self.cachefile, dict(version=self.version, files=files))
+
+        for entry in files.values():
+            objectpath = entry['object']
+            self.types[objectpath] = entry['type']
+            self.uses.setdefault(objectpath, set()).update(entry['uses'])
+            if entry['type'] == 'widget':
+                dashboard = str(Path(objectpath).parent.parent)
+                self.uses.setdefault(dashboard, set()).add(objectpath)
+        self._usedBy = None
+        return self
+
+    def usedBy(self, objectpath):
+        "Objects directly using the given one"
+        if self._usedBy is None:
+            self._usedBy = {}
+            for user, used in self.uses.items():
+                for objectused in used:
+                    self._usedBy.setdefault(objectused, set()).add(user)
+        return self._usedBy.get(objectpath, set())
+
+    def _closure(self, objectpaths, neighbours):
+        found = set()
+        pending = list(objectpaths)
+        while pending:
+            for neighbour in neighbours(pending.pop()):
+                if neighbour in found: continue
+                found.add(neighbour)
+                pending.append(neighbour)
+        return found
+
+    def dependencies(self, *objectpaths):
+        "Objects used, directly or not, by the given ones"
+        return self._closure(objectpaths, lambda path: self.uses.get(path, ()))
+
+    def dependants(self, *objectpaths):
+        "Objects using, directly or not, the given ones"
+        return self._closure(objectpaths, self.usedBy)
@@ -1,68 +1,325 @@
 from yamlns import namespace as ns
 from pathlib import Path
-import cutlet
-katsu = cutlet.Cutlet()
+from consolemsg import fail
+from .files import atomicWrite, loadJson, dumpJson
+from .trace import span
+from .serialization import loadYaml, dumpYaml
+from decorator import decorator
+import threading
+import os
+
+_katsu = None
+
+def katsu():
+    "Returns the shared Cutlet romanizer, loading it on first use"
+    global _katsu
+    if _katsu is None:
+        import cutlet
+        _katsu = cutlet.Cutlet()
+    return _katsu
+
+def createMapper(repopath, config):
+    """Builds the mapper for a server configuration,
+    honoring its `mapstore` and `mapcheckpoint` settings.
+    """
+    checkpoint = config.get('mapcheckpoint')
+    store = config.get('mapstore', 'yaml')
+    if store == 'yaml':
+        return Mapper(repopath, config.name, checkpoint=checkpoint)
+    if store == 'sqlite':
+        dbfile = config.get('mapdb')
+        return SqliteMapper(repopath, config.name,
+            dbfile=dbfile and Path(dbfile),
+            checkpoint=checkpoint,
+        )
+    fail("Unknown map store '{}' for server '{}'. Try with 'yaml' or 'sqlite'."
+        .format(store, config.name))
+
+@decorator
+def _locked(f, self, *args, **kwds):
+    "Serializes the calls to the decorated mapper method among threads"
+    with self._lock:
+        return f(self, *args, **kwds)
 
 class Mapper(object):
     """Keeps track of the binding of server objects
     with file paths.
+
+    The map is loaded once and kept in memory for the
+    life of the mapper. Changes are written back on flush(),
+    or every `checkpoint` changes if specified.
+
+    Public methods are safe to be called from several threads.
     """
-    def __init__(self, repopath, servername):
+    def __init__(self, repopath, servername, checkpoint=None):
         self.repopath = repopath
         self.servername = servername
         self.mapfile = self.repopath/'maps'/'{}.yaml'.format(servername)
+        self.checkpoint = checkpoint
+        self._maps = None
+        self._reverse = None
+        self._pending = 0
+        self.slugfile = self.repopath/'.redasher-ja'/'slugs.json'
+        self._slugs = None
+        self._newSlugs = 0
+        self._usedNames = {}
+        self._boundNames = None
+        self.listdir = os.listdir # names in use in a folder, may be replaced
+        self._nextSuffix = {}
+        self._lock = threading.RLock()
 
     def _load(self):
-        if not self.mapfile.exists():
-            return ns()
-        return ns.load(self.mapfile)
+        if self._maps is not None:
+            return self._maps
+        with span('load', 'mapper', file=str(self.mapfile)):
+            self._maps = loadYaml(self.mapfile) if self.mapfile.exists() else ns()
+        self._reverse = {
+            type: {str(path): id for id, path in objects.items()}
+            for type, objects in self._maps.items()
+        }
+        return self._maps
 
     def _save(self, content):
-        self.mapfile.parent.mkdir(exist_ok=True)
-        content.dump(self.mapfile)
+        with span('save', 'mapper', file=str(self.mapfile)):
+            atomicWrite(self.mapfile, dumpYaml(content))
+
+    def _objects(self, type):
+        maps = self._load()
+        self._reverse.setdefault(type, {})
+        return maps.setdefault(type, ns())
+
+    def _store(self, type, id, path):
+        objects = self._objects(type)
+        reverse = self._reverse[type]
+        oldpath = objects.get(id)
+        if oldpath is not None and reverse.get(oldpath) == id:
+            del reverse[oldpath]
+        objects[id] = str(path)
+        reverse[str(path)] = id
 
-    def _slugger(self, base):
-        "Returns first the slug as is, then adding sequence numbers"
-        slug = katsu.slug(base)
-        from itertools import count
-        yield slug
-        for c in count(2):
-            yield slug + "-{}".format(c)
+    def _setBinding(self, type, id, path):
+        self._store(type, id, path)
+        self._pending += 1
+        if self.checkpoint and self._pending >= self.checkpoint:
+            self.flush()
 
+    def _write(self):
+        self._save(self._maps)
+
+    @_locked
+    def flush(self):
+        "Writes the map and the slug cache if there are pending changes"
+        self._saveSlugs()
+        if not self._pending:
+            return
+        self._write()
+        self._pending = 0
+
+    def _loadSlugs(self):
+        if self._slugs is not None:
+            return self._slugs
+        self._slugs = loadJson(self.slugfile)
+        return self._slugs
+
+    def _saveSlugs(self):
+        if not self._newSlugs:
+            return
+        dumpJson(self.slugfile, self._slugs)
+        self._newSlugs = 0
+
+    @_locked
+    def slug(self, name):
+        "Romanized slug for name, memoized on disk among runs"
+        slugs = self._loadSlugs()
+        if name not in slugs:
+            with span('slug', 'slug', text=name):
+                slugs[name] = katsu().slug(name)
+            self._newSlugs += 1
+        return slugs[name]
+
+    @_locked
+    def bindings(self):
+        "Returns a namespace type -> id -> path with all the bindings"
+        return ns(
+            (type, ns(objects))
+            for type, objects in self._load().items()
+        )
+
+    def _boundNamesIn(self, folder):
+        "Names of the paths bound directly inside folder"
+        if self._boundNames is None:
+            self._boundNames = {}
+            for objects in self.bindings().values():
+                for path in objects.values():
+                    path = Path(path)
+                    self._boundNames.setdefault(str(path.parent), set()).add(path.name)
+        return self._boundNames.get(folder, ())
+
+    def _usedNamesIn(self, basePath):
+        """Names existing in basePath, listed once per session,
+        or bound, even if not written, as after a sync"""
+        key = str(basePath)
+        if key not in self._usedNames:
+            try:
+                self._usedNames[key] = set(self.listdir(key))
+            except FileNotFoundError:
+                self._usedNames[key] = set()
+            self._usedNames[key].update(self._boundNamesIn(key))
+        return self._usedNames[key]
+
+    def _freeName(self, basePath, slug, prefix='', suffix=''):
+        """Returns first the slug as is, then adding sequence numbers,
+        the first name not in use in basePath, and reserves it.
+        """
+        used = self._usedNamesIn(basePath)
+        name = prefix+slug+suffix
+        if name in used:
+            key = (str(basePath), prefix, slug, suffix)
+            c = self._nextSuffix.get(key, 2)
+            while prefix+slug+"-{}".format(c)+suffix in used:
+                c += 1
+            self._nextSuffix[key] = c + 1
+            name = prefix+slug+"-{}".format(c)+suffix
+        used.add(name)
+        return basePath / name
+
+    @_locked
     def track(self, type, basePath, anObject, prefix='', suffix=''):
         """
         Lookups in the server if the object id already has a file mapping.
         If not, looks one that does not exists and returns the path.
         """
-        maps = self._load()
-        objects = maps.setdefault(type, ns())
-        if anObject.id in objects:
-            return Path(objects[anObject.id])
-        for slug in self._slugger(anObject.get('name', type)):
-            objectPath = basePath / (prefix+slug+suffix)
-            if not objectPath.exists(): break
-        objects[anObject.id] = str(objectPath)
-        self._save(maps)
+        path = self.get(type, anObject.id)
+        if path is not None:
+            return Path(path)
+        slug = self.slug(anObject.get('name', type))
+        objectPath = self._freeName(basePath, slug, prefix, suffix)
+        self._setBinding(type, anObject.id, objectPath)
         return objectPath
 
+    @_locked
     def bind(self, type, id, path):
         """
         Binds an object id to the path for the server
         """
-        maps = self._load()
-        objects = maps.setdefault(type, ns())
-        objects[id] = str(path)
-        self._save(maps)
+        self._setBinding(type, id, path)
 
+    @_locked
     def get(self, type, id):
-        maps = self._load()
-        objects = maps.setdefault(type, ns())
+        objects = self._objects(type)
         return objects.get(id)
 
+    @_locked
     def remoteId(self, type, path):
-        maps = self._load()
-        objects = maps.setdefault(type, ns())
-        inversemap = {v:k for k,v in objects.items()}
-        return inversemap.get(str(path), None)
+        self._objects(type)
+        return self._reverse[type].get(str(path), None)
+
+    @_locked
+    def importYaml(self):
+        "Loads all the bindings in maps/<server>.yaml"
+        for type, objects in loadYaml(self.mapfile).items():
+            for id, path in objects.items():
+                self._setBinding(type, id, path)
+        self.flush()
+
+    @_locked
+    def exportYaml(self):
+        "Writes all the bindings into maps/<server>.yaml"
+        atomicWrite(self.mapfile, dumpYaml(self.bindings()))
+
+
+class SqliteMapper(Mapper):
+    """Mapper keeping the bindings in an indexed SQLite database
+    instead of loading the whole map in memory.
+
+    Several servers may share the same database file,
+    even from parallel commands, since every binding is committed
+    as soon as it is made instead of holding the write lock until flush().
+    Each (type, id) and each (type, path) is bound at most once per server.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS bindings (
+            server TEXT NOT NULL,
+            type TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            UNIQUE (server, type, id),
+            UNIQUE (server, type, path)
+        );
+        CREATE INDEX IF NOT EXISTS bindings_path ON bindings (server, path);
+    """
 
+    timeout = 30 # seconds to wait for another writer
+
+    def __init__(self, repopath, servername, dbfile=None, checkpoint=None):
+        super(SqliteMapper, self).__init__(repopath, servername,
+            checkpoint=checkpoint)
+        self.dbfile = dbfile or self.repopath/'.redasher-ja'/'maps.sqlite'
+        self._db = None
+
+    def _connection(self):
+        if self._db is not None:
+            return self._db
+        import sqlite3
+        self.dbfile.parent.mkdir(exist_ok=True, parents=True)
+        self._db = sqlite3.connect(str(self.dbfile),
+            timeout=self.timeout, check_same_thread=False)
+        # WAL lets readers go on while another mapper commits,
+        # and without fsyncing every commit
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.schema)
+        return self._db
+
+    def _store(self, type, id, path):
+        db = self._connection()
+        with db: # one short transaction per binding
+            db.execute(
+                "DELETE FROM bindings "
+                "WHERE server=? AND type=? AND path=? AND id<>?",
+                (self.servername, type, str(path), id))
+            db.execute(
+                "INSERT INTO bindings (server, type, id, path) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (server, type, id) DO UPDATE SET path=excluded.path",
+                (self.servername, type, id, str(path)))
+
+    def _write(self):
+        "Bindings are already committed by _store"
+
+    @_locked
+    def bindings(self):
+        result = ns()
+        rows = self._connection().execute(
+            "SELECT type, id, path FROM bindings WHERE server=? ORDER BY rowid",
+            (self.servername,))
+        for type, id, path in rows:
+            result.setdefault(type, ns())[id] = path
+        return result
+
+    def _boundNamesIn(self, folder):
+        # Range on the path index, instead of loading every binding
+        rows = self._connection().execute(
+            "SELECT path FROM bindings "
+            "WHERE server=? AND path>? AND path<?",
+            (self.servername, folder+os.sep, folder+chr(ord(os.sep)+1)))
+        return set(
+            path.name
+            for path in (Path(row[0]) for row in rows)
+            if str(path.parent) == folder
+        )
+
+    @_locked
+    def get(self, type, id):
+        row = self._connection().execute(
+            "SELECT path FROM bindings WHERE server=? AND type=? AND id=?",
+            (self.servername, type, id)).fetchone()
+        return row and row[0]
+
+    @_locked
+    def remoteId(self, type, path):
+        row = self._connection().execute(
+            "SELECT id FROM bindings WHERE server=? AND type=? AND path=?",
+            (self.servername, type, str(path))).fetchone()
+        return row and row[0]
 
@@ -3,12 +3,145 @@ import requests
 import os
 from decorator import decorator
 import itertools
+import threading
+import random
+import time
+import sys
+import json
+from collections import Counter, deque
+from .trace import span
+
+def fetchInOrder(fetch, items, jobs=1):
+    """Yields fetch(item) for every item keeping the item order,
+    while running up to `jobs` fetches concurrently.
+    """
+    if jobs <= 1:
+        yield from map(fetch, items)
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fetch, item))
+            if len(pending) >= 2*jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+class RateLimiter(object):
+    """Token bucket limiting the requests per second, shared among threads.
+
+    The rate adapts to the server: whenever it throttles us (slowDown),
+    at most once a second, the rate becomes half the one measured
+    over the last `window` seconds, and it is doubled back on success
+    (speedUp), at most once a second, up to the configured maximum.
+    Without a configured rate, no limit applies until the first throttling,
+    and the limit is lifted again once back to the rate throttled.
+    """
+    minrate = 0.5
+    window = 2. # seconds
+
+    def __init__(self, rate=None):
+        self.maxrate = rate
+        self.rate = rate
+        self.tokens = 1.
+        self.last = time.monotonic()
+        self.recent = deque() # request times within the window
+        self.lastSlowDown = None
+        self.lastChange = None # last time the rate was slowed down or recovered
+        self.ceiling = rate # rate to recover up to
+        self.lock = threading.Lock()
+
+    def _measured(self, now):
+        "Requests per second sent within the window"
+        if not self.recent:
+            return self.minrate
+        return len(self.recent) / max(now - self.recent[0], 0.1)
+
+    def acquire(self):
+        "Waits for a token, returns the seconds waited"
+        with self.lock:
+            now = time.monotonic()
+            self.recent.append(now)
+            while self.recent[0] < now - self.window:
+                self.recent.popleft()
+            if self.rate is None:
+                return 0
+            self.tokens = min(
+                max(1., self.rate),
+                self.tokens + (now - self.last) * self.rate,
+            )
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def slowDown(self):
+        with self.lock:
+            now = time.monotonic()
+            # Concurrent requests are throttled together, count them once
+            if self.lastSlowDown is not None and now - self.lastSlowDown < 1:
+                return
+            self.lastSlowDown = now
+            self.lastChange = now
+            current = self._measured(now)
+            if self.rate is not None:
+                current = min(current, self.rate)
+            if self.maxrate is None:
+                self.ceiling = current
+            self.rate = max(self.minrate, current / 2.)
+            self.tokens = min(self.tokens, 0.)
+
+    def speedUp(self):
+        with self.lock:
+            if self.rate is None or self.rate == self.maxrate: return
+            now = time.monotonic()
+            if now - self.lastChange < 1: return
+            self.lastChange = now
+            self.rate *= 2
+            if self.rate >= self.ceiling:
+                self.rate = self.maxrate
+
 
 class Redash(object):
-    def __init__(self, redash_url, api_key):
+    # Responses worth a retry, the server did not process the request
+    retryStatus = (429, 502, 503, 504)
+    # For non idempotent methods, just the ones sure not to be processed
+    retryStatusUnsafe = (429, 503)
+
+    def __init__(self, redash_url, api_key, poolsize=10, pagesize=100, pagejobs=4,
+            retries=5, backoff=0.5, timeout=(10, 120), ratelimit=None, cache=None,
+            keepalive=True, compression=True, noproxy=False, versioncache=None):
         self.redash_url = redash_url
+        self.cache = cache # a ResponseCache for full object GETs
+        self.versioncache = versioncache # a VersionCache for the status probe
+        self._version = None
+        self._versionLock = threading.Lock()
+        self.pagesize = pagesize # Redash accepts up to 250
+        self.pagejobs = pagejobs
+        self.retries = retries
+        self.backoff = backoff # seconds, doubled on each retry
+        self.timeout = timeout # seconds, (connect, read) or both
+        self.limiter = RateLimiter(ratelimit)
+        self.stats = Counter() # requests, retries, throttled (seconds)
+        self._statsLock = threading.Lock()
         self.session = requests.Session()
+        # Connections kept open to reuse, one per concurrent request
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=poolsize,
+            pool_maxsize=poolsize,
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.session.headers.update({'Authorization': 'Key {}'.format(api_key)})
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate' if compression else 'identity'
+        if not keepalive:
+            self.session.headers['Connection'] = 'close'
+        # Environment proxies are not used for hosts matching no_proxy
+        self.proxies = dict(no_proxy='*') if noproxy else None
 
     def test_credentials(self):
         try:
@@ -20,6 +153,17 @@ class Redash(object):
     def status(self):
         return self._get('status.json').json()
 
+    def version(self):
+        """Server version, probed from the status once per client
+        unless the version cache still knows it"""
+        with self._versionLock:
+            if self._version is None:
+                cached = self.versioncache and self.versioncache.get(self.redash_url)
+                self._version = cached or self.status()['version']
+                if self.versioncache and not cached:
+                    self.versioncache.store(self.redash_url, self._version)
+            return self._version
+
     def users(self):
         """GET api/users"""
         return self._paginated_get('api/users')
@@ -34,19 +178,19 @@ class Redash(object):
 
     def datasources(self):
         """GET api/data_sources"""
-        return self._get('api/data_sources').json()
+        return self._cachedGet('api/data_sources')
 
     def datasource(self, id):
         """GET api/data_sources/{id}"""
-        return self._get('api/data_sources/{}'.format(id)).json()
+        return self._cachedGet('api/data_sources/{}'.format(id))
 
     def dashboard(self, slug):
         """GET api/dashboards/{slug}"""
-        return self._get('api/dashboards/{}'.format(slug)).json()
+        return self._cachedGet('api/dashboards/{}'.format(slug))
 
     def query(self, id):
         """GET api/dashboards/{id}"""
-        return self._get('api/queries/{}'.format(id)).json()
+        return self._cachedGet('api/queries/{}'.format(id))
 
     def create_query(self, data_source_id, query, is_draft, is_archived, schedule, name, description, options, **kwds):
         data = {
@@ -71,14 +215,9 @@ class Redash(object):
         }
         return self._post('api/visualizations', json=data).json()
 
-    def update_visualization(self, visualization_id, query_id, type, name, description, options):
-        data = {
-            "name": name,
-            "description": description,
-            "options": options,
-            "type": type,
-            "query_id": query_id,
-        }
+    def update_visualization(self, visualization_id, **data):
+        """POST api/visualizations/{visualization_id} with the fields
+        to change among query_id, type, name, description and options"""
         return self._post('api/visualizations/{}'.format(visualization_id), json=data).json()
 
     def create_dashboard(self, name):
@@ -122,6 +261,11 @@ class Redash(object):
         """Loads all queries and returns only the scheduled ones."""
         return (query for query in self.queries() if query['schedule'] is not None)
 
+    def query_result(self, result_id):
+        """GET api/query_results/{result_id} as a streamed response.
+        The caller must close it."""
+        return self._get('api/query_results/{}'.format(result_id), stream=True)
+
     def update_query(self, query_id, data):
         """POST /api/queries/{query_id} with the provided data object."""
         path = 'api/queries/{}'.format(query_id)
@@ -134,15 +278,43 @@ class Redash(object):
         return self._delete('api/query/{}'.format(query_id))
 
     def _paginated_get(self, path, **kwds):
-        page_size=100
-        for page in itertools.count(1):
-            response =  self._get(path, params=dict(kwds,
+        """Yields the results of all the pages in server order.
+        Once the first page tells the count, the rest of pages
+        are retrieved up to `pagejobs` at a time.
+        """
+        def getPage(page):
+            return self._get(path, params=dict(kwds,
                 page=page,
-                page_size=page_size,
+                page_size=self.pagesize,
             )).json()
+
+        response = getPage(1)
+        yield from response['results']
+        # the server might have capped the page size
+        page_size = response['page_size']
+        npages = -(-response['count'] // page_size)
+        for response in fetchInOrder(getPage, range(2, npages+1), self.pagejobs):
             yield from response['results']
-            if response['page'] * response['page_size'] >= response['count']:
-                break
+
+    def _cachedGet(self, path):
+        """GET path decoded as json, through the response cache if any"""
+        if not self.cache:
+            return self._get(path).json()
+        url = '{}/{}'.format(self.redash_url, path)
+        cached = self.cache.get(url)
+        headers = {}
+        if cached:
+            body, headers, fresh = cached
+            if fresh:
+                self._count(cachehits=1)
+                return json.loads(body)
+        response = self._get(path, headers=headers)
+        if cached and response.status_code == 304:
+            self._count(cachehits=1)
+            self.cache.touch(url)
+            return json.loads(body)
+        self.cache.store(url, response)
+        return response.json()
 
     def _delete(self, path, **kwargs):
         return self._request('DELETE', path, **kwargs)
@@ -153,18 +325,85 @@ class Redash(object):
     def _post(self, path, **kwargs):
         return self._request('POST', path, **kwargs)
 
+    def _count(self, **increments):
+        with self._statsLock:
+            self.stats.update(increments)
+
+    def _retryDelay(self, attempt, response=None):
+        "Seconds to wait before the next attempt"
+        retryAfter = response is not None and response.headers.get('Retry-After')
+        if retryAfter:
+            try:
+                return float(retryAfter)
+            except ValueError:
+                from email.utils import parsedate_to_datetime
+                from datetime import datetime, timezone
+                try:
+                    date = parsedate_to_datetime(retryAfter)
+                except (TypeError, ValueError):
+                    pass
+                else:
+                    return max(0., (date - datetime.now(timezone.utc)).total_seconds())
+        # exponential backoff with full jitter
+        return random.uniform(0, self.backoff * 2**attempt)
+
     def _request(self, method, path, **kwargs):
-        try:
-            url = '{}/{}'.format(self.redash_url, path)
-            response = self.session.request(method, url, **kwargs)
-            response.raise_for_status()
-            return response
-        except:
-            from yamlns import namespace as ns
-            print("{} {}\n{}".format(
-                method, path, ns(kwargs).dump()
-            ))
-            raise
+        """Sends the request under the rate limit, retrying with backoff
+        responses and connection errors the server did not process.
+        Non idempotent POSTs are only retried when that is sure.
+        """
+        url = '{}/{}'.format(self.redash_url, path)
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('proxies', self.proxies)
+        safe = method in ('GET', 'HEAD', 'OPTIONS', 'DELETE')
+        retryable = self.retryStatus if safe else self.retryStatusUnsafe
+        for attempt in itertools.count():
+            last = attempt >= self.retries
+            throttled = self.limiter.acquire()
+            self._count(requests=1, throttled=throttled)
+            try:
+                with span(method, 'http', path=path, attempt=attempt) as traced:
+                    response = self.session.request(method, url, **kwargs)
+                    traced.update(
+                        status=response.status_code,
+                        # Streamed bodies are read later by the caller
+                        bytes=int(response.headers.get('Content-Length') or 0)
+                            if kwargs.get('stream') else len(response.content),
+                    )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                unprocessed = isinstance(e, requests.exceptions.ConnectTimeout)
+                if last or not (safe or unprocessed):
+                    print("{} {} failed: {}".format(method, path, e), file=sys.stderr)
+                    raise
+                delay = self._retryDelay(attempt)
+            else:
+                if response.status_code == 429:
+                    self.limiter.slowDown()
+                if response.status_code not in retryable or last:
+                    if response.ok:
+                        self.limiter.speedUp()
+                        if self.cache and method != 'GET':
+                            # Cached objects might be affected
+                            self.cache.invalidate(self.redash_url + '/')
+                    try:
+                        response.raise_for_status()
+                    except requests.exceptions.HTTPError as e:
+                        print("{} {} failed: {}".format(method, path, e), file=sys.stderr)
+                        raise
+                    return response
+                delay = self._retryDelay(attempt, response)
+                response.close()
+            self._count(retries=1, throttled=delay)
+            time.sleep(delay)
+
+    def summary(self):
+        "Human readable request counters"
+        return "Requests: {}, retries: {}, throttled: {:.1f}s, cache hits: {}".format(
+            self.stats['requests'],
+            self.stats['retries'],
+            self.stats['throttled'],
+            self.stats['cachehits'],
+        )
 
 
 if __name__ == '__main__':
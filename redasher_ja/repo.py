@@ -3,11 +3,30 @@
 from pathlib import Path
 from packaging import version
 from yamlns import namespace as ns
-from consolemsg import fail, step, warn
-from .redash import Redash
-from .mapper import Mapper
+from consolemsg import fail, step, warn, out
+from .redash import Redash, fetchInOrder
+from .mapper import createMapper, SqliteMapper
+from .httpcache import ResponseCache, VersionCache
+from .trace import span
+from .files import writeIfChanged, loadJson, dumpJson
+from .index import RepoIndex
+from .results import downloadQueryResult
+from .tree import FileTree, MemoryTree
+from .bundle import BundleWriter, BundleTree
+from .gitcommit import GitCommit
+from .watch import createWatcher
+from .serialization import dumpYaml
+from collections import Counter
 import sys
 import os
+import json
+import hashlib
+import copy
+import difflib
+import threading
+import time
+from fnmatch import fnmatch
+from datetime import datetime, timezone
 
 configfile = Path(os.getcwd(),'.redasher-ja/config.yaml')
 
@@ -29,13 +48,58 @@ def serverConfig(servername=None):
         ))
     return ns(servers.get(servername), name=servername)
 
-def setServerConfig(servername, url, apikey):
+def connect(config, poolsize=1):
+    """Returns a Redash client for a server configuration,
+    with connections for `poolsize` concurrent requests
+    unless the configuration sets a `poolsize`"""
+    # yamlns loads decimals, sockets and sleeps want floats
+    timeout = config.get('timeout', (10, 120))
+    if isinstance(timeout, (list, tuple)):
+        timeout = tuple(map(float, timeout))
+    else:
+        timeout = float(timeout)
+    ratelimit = config.get('ratelimit')
+    pagejobs = config.get('pagejobs', 4)
+    cache = None
+    if config.get('httpcache'):
+        cache = ResponseCache(configfile.parent/'httpcache.sqlite',
+            ttl=config.get('httpcachettl', 3600),
+            maxsize=config.get('httpcachesize', 200)*1024*1024,
+        )
+    return Redash(config.url, config.apikey,
+        poolsize=config.get('poolsize') or max(poolsize, pagejobs),
+        pagesize=config.get('pagesize', 100),
+        pagejobs=pagejobs,
+        retries=config.get('retries', 5),
+        backoff=float(config.get('backoff', 0.5)),
+        timeout=timeout,
+        ratelimit=None if ratelimit is None else float(ratelimit),
+        cache=cache,
+        keepalive=config.get('keepalive', True),
+        compression=config.get('compression', True),
+        noproxy=config.get('noproxy', False),
+        versioncache=VersionCache(configfile.parent/'versions.json',
+            ttl=float(config.get('versionttl', 24*3600)),
+        ),
+    )
+
+# Transport settings setup may give a server
+transportSettings = ('poolsize', 'timeout', 'keepalive', 'compression', 'noproxy')
+
+def setServerConfig(servername, url, apikey, **transport):
+    """Sets the url and the api key of a server,
+    and the transport settings given, not None.
+    Other settings already there are kept."""
     config = loadConfig()
     servers = config.setdefault('servers', ns())
-    servers[servername] = ns(
+    server = servers[servername] = ns(
+        servers.get(servername) or (),
         url=url,
         apikey=apikey,
     )
+    for setting in transportSettings:
+        if transport.get(setting) is not None:
+            server[setting] = transport[setting]
     config.setdefault('defaultserver', servername)
     configfile.parent.mkdir(exist_ok=True)
     config.dump(configfile)
@@ -106,21 +170,19 @@ def _cleanUp(object, type):
             continue
         del object[attribute]
 
-def _dump(filename, content):
-    filename.parent.mkdir(exist_ok=True, parents=True)
-    normalized = filename
-    if filename.name in ('metadata.yaml'):
-        normalized = filename.parent
-    filetype = _path2type(normalized)
-    print(filetype, filename)
-    _cleanUp(content, filetype)
-    content = ns(sorted(content.items()))
-    content.dump(filename)
-
-def _write(filename, content):
-    filename.parent.mkdir(exist_ok=True)
-    print(_path2type(filename), filename)
-    filename.write_text(content, encoding='utf8')
+# Counts of 'written' and 'unchanged' files by Downloader._dump and _write
+writeStats = Counter()
+
+def _fileType(filename):
+    "Type of the object held in a YAML file"
+    if filename.name == 'metadata.yaml':
+        filename = filename.parent
+    return _path2type(filename)
+
+def _fileContent(filename, content):
+    "The content to be dumped into filename, cleaned up and sorted"
+    _cleanUp(content, _fileType(filename))
+    return ns(sorted(content.items()))
 
 def parentObjectPath(path):
     return Path(*path.parts[:2])
@@ -153,104 +215,543 @@ def _path2type(path):
             return None
         return 'query'
 
-def _read(path):
-    return path.read_text(encoding='utf8')
-
 
 
-from decorator import decorator
+def runGraph(graph, run, jobs=1):
+    """Calls run(node) for every node in graph, a dict node -> its
+    dependency nodes, after all its dependencies are done, running
+    up to `jobs` nodes concurrently. Ready nodes start in graph order.
+    Stops at the first failing node, raising its exception.
+    """
+    waiting = {node: set(deps) for node, deps in graph.items()}
+    dependants = {node: [] for node in graph}
+    for node, deps in graph.items():
+        for dep in deps:
+            dependants[dep].append(node)
+    ready = [node for node, deps in waiting.items() if not deps]
+
+    def done(node):
+        for dependant in dependants[node]:
+            waiting[dependant].discard(node)
+            if not waiting[dependant]:
+                ready.append(dependant)
+        del waiting[node]
+
+    if jobs <= 1:
+        while ready:
+            node = ready.pop(0)
+            run(node)
+            done(node)
+    else:
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            running = {}
+            while ready or running:
+                while ready and len(running) < jobs:
+                    node = ready.pop(0)
+                    running[executor.submit(run, node)] = node
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    if future.exception() is not None:
+                        for pending in running:
+                            pending.cancel()
+                        wait(running)
+                        raise future.exception()
+                    done(node)
+    if waiting:
+        fail("Dependency cycle among:\n" + "\n".join(
+            "  {} {}".format(*node) for node in waiting))
+
+def runStream(nodes, run, jobs=1):
+    """Like runGraph but taking the graph as an iterable of
+    (node, dependency nodes), so that nodes run, up to `jobs`
+    at a time, while the following ones are still being produced.
+    Nodes wait for dependencies not produced yet.
+    Repeated nodes are ignored.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    lock = threading.Condition()
+    seen = set()
+    done = set()
+    waiting = {}
+    dependants = {}
+    errors = []
+    running = 0
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+
+        def submit(node):
+            nonlocal running
+            running += 1
+            executor.submit(execute, node)
+
+        def execute(node):
+            nonlocal running
+            try:
+                run(node)
+            except BaseException as exception:
+                with lock:
+                    errors.append(exception)
+            with lock:
+                running -= 1
+                if not errors:
+                    done.add(node)
+                    for dependant in dependants.pop(node, []):
+                        waiting[dependant].discard(node)
+                        if not waiting[dependant]:
+                            del waiting[dependant]
+                            submit(dependant)
+                lock.notify_all()
 
-def level(type):
-    def _wrap(f, *args, **kwds):
-        self = args[0]
-        filename = Path(args[1])
-        id = None
         try:
-            id = self.enterLevel(type, filename)
-            if id: return id
-            id = f(self, filename)
+            for node, deps in nodes:
+                with lock:
+                    if errors: break
+                    if node in seen: continue
+                    seen.add(node)
+                    deps = set(deps) - done
+                    if not deps:
+                        submit(node)
+                        continue
+                    waiting[node] = deps
+                    for dep in deps:
+                        dependants.setdefault(dep, []).append(node)
+        except BaseException as exception:
+            with lock:
+                errors.append(exception)
         finally:
-            self.exitLevel(type, filename, id)
-        return id
-
-    return decorator(_wrap)
+            with lock:
+                while running:
+                    lock.wait()
+    if errors:
+        raise errors[0]
+    if waiting:
+        fail("Missing dependencies or cycle among:\n" + "\n".join(
+            "  {} {}".format(*node) for node in waiting))
+
+
+def _parameterQueryIds(query):
+    "Server ids of the queries giving values to the parameters of a server query"
+    return [
+        parameter['queryId']
+        for parameter in (query.get('options') or {}).get('parameters', [])
+        if isinstance(parameter.get('queryId'), int)
+    ]
+
+def _dashboardIdField(redash):
+    "Dashboards are addressed by slug before Redash 9, by id since"
+    dashboard_with_slugs = version.parse(redash.version()) < version.parse('9-alpha')
+    return 'slug' if dashboard_with_slugs else 'id'
+
+def _plain(value):
+    "Json like value as plain dicts and lists, comparable regardless of key order"
+    return json.loads(json.dumps(value, default=str))
+
+_missing = object()
+
+def _fieldChanges(old, new, path):
+    "Yields (path, old, new) for every differing leaf of two json like values"
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in sorted(set(old) | set(new)):
+            yield from _fieldChanges(
+                old.get(key, _missing), new.get(key, _missing),
+                '{}.{}'.format(path, key))
+        return
+    if old != new:
+        yield path, old, new
+
+def _formatChange(path, old, new):
+    "Text for a field change, multiline texts as a unified diff"
+    if isinstance(old, str) and isinstance(new, str) and '\n' in old + new:
+        return "{}:\n{}".format(path, "\n".join(
+            '      ' + line.rstrip('\n')
+            for line in difflib.unified_diff(
+                old.splitlines(), new.splitlines(), 'server', 'local', lineterm='')
+        ))
+    show = lambda value: '(none)' if value is _missing else json.dumps(value, ensure_ascii=False)
+    return "{}: {} -> {}".format(path, show(old), show(new))
 
+# consolemsg writes a message and its newline apart,
+# messages from upload jobs must not get in between
+_outputLock = threading.Lock()
 
+def _payloadDigest(payload):
+    "Hash of a normalized json serialization of the payload"
+    serialized = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode('utf8')).hexdigest()
 
 class Uploader(object):
-    def __init__(self, servername):
+    """Uploads file objects and their dependencies to a server.
+
+    The files to upload are first gathered into a dependency graph
+    following the cascading rules, then uploaded up to `jobs`
+    at a time, each one as soon as the remote ids it refers to are known.
+
+    A per server manifest keeps the hash of the payloads last sent
+    for every file object. Objects whose payload, including the remote
+    ids it refers to, did not change are not sent again unless `force`.
+
+    With `fromPlan`, the current server state of the bound objects
+    is fetched first and, instead of the manifest, used to send
+    just the fields that differ, along with the version seen,
+    so that the server refuses to overwrite later changes.
+
+    File objects are read from the working directory
+    unless another `tree` is given.
+    """
+    def __init__(self, servername, force=False, jobs=1, fromPlan=False, tree=None):
         config = serverConfig(servername)
         self.servername = config.name # param might be None, this solves
-        self.redash = Redash(config.url, config.apikey)
-        self.mapper = Mapper(Path('.'), config.name)
-
-        self.uploaded = set()
-        self.levels = 0
+        self.jobs = jobs
+        self.redash = connect(config, poolsize=jobs)
+        self.mapper = createMapper(Path('.'), config)
+        self.force = force
+        self.fromPlan = fromPlan
+        self.tree = tree or FileTree(Path('.'))
+        self.remote = {}
+        self.manifestfile = configfile.parent/'state'/'{}.uploads.json'.format(config.name)
+        self.manifest = loadJson(self.manifestfile)
+
+        self.contents = {}
         self.unboundDefaultVisualizations = ns()
 
     def step(self, msg, *args, **kwds):
-        step("  "*self.levels + msg, *args, **kwds)
+        with _outputLock:
+            step(msg, *args, **kwds)
 
     def warn(self, msg, *args, **kwds):
-        warn("  "*self.levels + msg, *args, **kwds)
-
-    def enterLevel(self, objecttype, filename):
-        self.levels +=1
-
-        if filename in self.uploaded:
-            self.step("Skipped {} {}", objecttype, filename)
-            return self.mapper.remoteId(objecttype, filename)
-
-        id = self.mapper.remoteId(objecttype, filename)
-        self.step("{} {} {}", "Update" if id else "Create", objecttype, filename)
-        filetype = _path2type(filename)
-        if filetype != objecttype:
-            fail("{} is not a {} but a {}".format(filename, objecttype, filetype))
-
-        self.uploaded.add(filename)
-        return False
-
-    def exitLevel(self, objecttype, filename, id):
-        #self.step("Done {} {} = {}", objecttype, filename, id)
-        self.levels -=1
+        with _outputLock:
+            warn(msg, *args, **kwds)
+
+    def _unchanged(self, filename, *payload):
+        "Whether the payload is the last one uploaded for filename"
+        if self.force or self.fromPlan:
+            return False
+        if self.manifest.get(str(filename)) != _payloadDigest(payload):
+            return False
+        self.step("Unchanged {}", filename)
+        return True
+
+    def _remember(self, filename, *payload):
+        "Records the payload just uploaded for filename"
+        self.manifest[str(filename)] = _payloadDigest(payload)
 
     def upload(self, *filenames):
+        try:
+            self._upload(*filenames)
+        finally:
+            self.mapper.flush()
+            dumpJson(self.manifestfile, self.manifest)
+        step(self.redash.summary())
+
+    def _roots(self, filenames):
+        roots = []
         for filename in filenames:
-            self.step("Recursive upload starting at {}", filename)
             filename = Path(filename)
             if filename.name == 'metadata.yaml':
                 filename = filename.parent
             filetype = _path2type(filename)
-            handler = dict(
-                dashboard = self.uploadDashboard,
-                query = self.uploadQuery,
-                widget = self.uploadWidget,
-                visualization = self.uploadVisualization,
-            ).get(filetype, None)
-            if not handler:
+            if filetype not in self.handlers:
                 fail("Unsuported file object type '{}'".format(filename))
-            handler(filename)
+            roots.append((filetype, filename))
+        return roots
 
+    def _upload(self, *filenames):
+        for filename in filenames:
+            self.step("Recursive upload starting at {}", filename)
+        graph = self.dependencies(*self._roots(filenames))
+        if self.fromPlan:
+            self._fetchRemote(graph)
+        runGraph(graph, self._uploadNode, self.jobs)
+        self._warnUnbound()
+
+    def uploadChanged(self, *filenames):
+        """Uploads the file objects and the objects they require,
+        but not the ones they contain, unless not bound yet"""
+        try:
+            graph = {}
+            pending = self._roots(filenames)
+            while pending:
+                node = pending.pop(0)
+                if node in graph: continue
+                requires, cascades = self._links(*node)
+                graph[node] = set(requires)
+                pending.extend(requires if self.mapper.remoteId(*node) else cascades)
+            self._chainDefaultVisualizations(graph)
+            runGraph(graph, self._uploadNode, self.jobs)
+            self._warnUnbound()
+        finally:
+            self.mapper.flush()
+            dumpJson(self.manifestfile, self.manifest)
+
+    def uploadStream(self, roots):
+        """Uploads the queries and dashboards, given as (type, path)
+        by the roots iterable, with their visualizations or widgets,
+        while the roots are still being produced.
+        The objects they require must come sooner or later as roots
+        or be already bound, as data sources are.
+        """
+        try:
+            runStream(self._streamGraph(roots), self._uploadNode, self.jobs)
+            self._warnUnbound()
+        finally:
+            self.mapper.flush()
+            dumpJson(self.manifestfile, self.manifest)
+
+    def _streamGraph(self, roots):
+        "Yields (node, requirements) for the roots and their parts"
+        for root in roots:
+            group = {}
+            pending = [root]
+            while pending:
+                node = pending.pop(0)
+                requires, cascades = self._links(*node)
+                group[node] = set(requires)
+                pending.extend(
+                    child for child in cascades
+                    if child[0] in ('visualization', 'widget')
+                    and parentObjectPath(child[1]) == root[1]
+                    and child not in group
+                )
+            self._chainDefaultVisualizations(group)
+            for node, requires in group.items():
+                for required in requires:
+                    if required[0] == 'datasource':
+                        yield required, set()
+                yield node, requires
+
+    def _warnUnbound(self):
         for view, visId in self.unboundDefaultVisualizations.items():
             warn("Unbound default TABLE visualization {} created for {}".
                 format(visId, view)
             )
 
-    @level('dashboard')
-    def uploadDashboard(self, filename):
-
-        metadatafile = filename/'metadata.yaml'
-        dashboard = ns.load(metadatafile)
-
-        dashboardId = self.mapper.remoteId('dashboard', filename)
-        if not dashboardId:
-            dashboardId = ns(self.redash.create_dashboard(dashboard.name)).id
-            self.mapper.bind('dashboard', dashboardId, filename)
-            self.step("Created a new dashboard {}", dashboardId)
-
-        # TODO: Compare update date with last date from server
+    handlers = dict(
+        dashboard = 'uploadDashboard',
+        query = 'uploadQuery',
+        widget = 'uploadWidget',
+        visualization = 'uploadVisualization',
+    )
 
-        params = {
+    def _uploadNode(self, node):
+        objecttype, filename = node
+        id = self.mapper.remoteId(objecttype, filename)
+        if objecttype != 'datasource':
+            self.step("{} {} {}", "Update" if id else "Create", objecttype, filename)
+        handler = getattr(self,
+            self.handlers.get(objecttype, 'uploadDataSource'))
+        return handler(filename)
+
+    def _content(self, filename):
+        return self.contents[filename]
+
+    def _links(self, objecttype, filename):
+        """Loads a file object and returns the objects it needs
+        uploaded before, and the ones uploaded along with it.
+        """
+        if objecttype == 'datasource':
+            return [], []
+
+        if objecttype == 'dashboard':
+            self.contents[filename] = self.tree.load(filename/'metadata.yaml')
+            widgets = [
+                ('widget', widgetfile)
+                for widgetfile in self.tree.glob(filename, 'widgets/*.yaml')
+            ]
+            return [], widgets
+
+        if objecttype == 'widget':
+            widget = self.contents[filename] = self.tree.load(filename)
+            requires = [('dashboard', parentObjectPath(filename))]
+            if widget.get('visualization'):
+                requires.append(('visualization',
+                    self._reference(filename, 'visualization', widget.visualization)))
+            return requires, requires
+
+        if objecttype == 'query':
+            query = self.contents[filename] = ns(self.tree.load(filename/'metadata.yaml'))
+            query.query = self.tree.read(filename/'query.sql')
+            requires = []
+            if query.get('data_source_id'):
+                requires.append(('datasource', Path(query.data_source_id)))
+            for parameter in query.options.get('parameters', []):
+                if 'queryId' in parameter:
+                    requires.append(('query',
+                        self._reference(filename, 'query', parameter.queryId)))
+            visualizations = [
+                ('visualization', visualizationfile)
+                for visualizationfile in self.tree.glob(filename, 'visualizations/*.yaml')
+            ]
+            return requires, requires + visualizations
+
+        if objecttype == 'visualization':
+            self.contents[filename] = self.tree.load(filename)
+            requires = [('query', parentObjectPath(filename))]
+            return requires, requires
+
+    def _reference(self, filename, objecttype, reference):
+        "Path of an object referred by a file object, failing on server ids"
+        if not isinstance(reference, str):
+            fail("{} refers to the {} with id {} in the server it was checked out from, "
+                "which was not checked out. Check it out to refer to it by path."
+                .format(filename, objecttype, reference))
+        return Path(reference)
+
+    def dependencies(self, *roots):
+        """Returns the graph of file objects to upload when uploading
+        the roots, as a dict (type, path) -> set of (type, path)
+        that have to be uploaded before.
+        """
+        graph = {}
+        pending = list(roots)
+        while pending:
+            node = pending.pop(0)
+            if node in graph: continue
+            objecttype, filename = node
+            filetype = _path2type(filename)
+            if filetype != objecttype:
+                fail("{} is not a {} but a {}".format(filename, objecttype, filetype))
+            requires, cascades = self._links(objecttype, filename)
+            graph[node] = set(requires)
+            pending.extend(cascades)
+        self._chainDefaultVisualizations(graph)
+        return graph
+
+    def _chainDefaultVisualizations(self, graph):
+        """The default visualization of a new query is bound to its
+        first TABLE one, so they are made to be uploaded in order"""
+        previous = {}
+        for objecttype, filename in list(graph):
+            if objecttype != 'visualization': continue
+            if self._content(filename).get('type') != 'TABLE': continue
+            queryfile = parentObjectPath(filename)
+            if queryfile in previous:
+                graph['visualization', filename].add(previous[queryfile])
+            previous[queryfile] = ('visualization', filename)
+
+    def _fetchRemote(self, graph):
+        """Fetches concurrently the server state of the bound queries
+        and dashboards in the graph and, within them, the one of
+        their visualizations and widgets, keeping it by (type, id).
+        """
+        bound = [
+            (objecttype, self.mapper.remoteId(objecttype, filename))
+            for objecttype, filename in graph
+            if objecttype in ('query', 'dashboard')
+        ]
+        bound = [(objecttype, id) for objecttype, id in bound if id]
+        dashboardKeys = {}
+        if any(objecttype == 'dashboard' for objecttype, id in bound):
+            idfield = _dashboardIdField(self.redash)
+            if idfield != 'id':
+                dashboardKeys = {
+                    summary['id']: summary[idfield]
+                    for summary in self.redash.dashboards()
+                }
+
+        def fetch(node):
+            objecttype, id = node
+            if objecttype == 'query':
+                return self.redash.query(id)
+            return self.redash.dashboard(dashboardKeys.get(id, id))
+
+        for (objecttype, id), remote in zip(bound, fetchInOrder(fetch, bound, self.jobs)):
+            self.remote[objecttype, id] = remote
+            childtype = 'visualization' if objecttype == 'query' else 'widget'
+            for child in remote.get(childtype + 's') or []:
+                self.remote[childtype, child['id']] = child
+
+    def _remoteFields(self, objecttype, id):
+        "Remote state of an object comparable to its payload, or None"
+        remote = self.remote.get((objecttype, id))
+        if remote is None:
+            return None
+        remote = _plain(remote)
+        _cleanUp(remote, objecttype)
+        if objecttype == 'query':
+            remote['query'] = self.remote[objecttype, id].get('query')
+        if objecttype == 'widget':
+            remote['visualization_id'] = (remote.get('visualization') or {}).get('id')
+        return remote
+
+    def _planned(self, objecttype, id, payload):
+        """When uploading from a plan, reduces the payload to the
+        fields that differ from the remote state, plus the version seen.
+        Otherwise, or if the remote state is unknown, returns it whole.
+        """
+        remote = self._remoteFields(objecttype, id) if self.fromPlan else None
+        if remote is None:
+            return payload
+        changes = ns(
+            (key, value)
+            for key, value in payload.items()
+            if key in remote and _plain(value) != remote[key]
+        )
+        if not changes:
+            return changes
+        if objecttype == 'widget':
+            return payload # Redash requires all the widget fields
+        version = self.remote[objecttype, id].get('version')
+        if version is not None:
+            changes.version = version
+        return changes
+
+    def _payload(self, objecttype, filename):
+        "What uploading the object would send, with the current bindings"
+        if objecttype == 'query':
+            params, tags = self._queryPayload(filename)
+            return ns(params, **tags)
+        builder = dict(
+            dashboard = self._dashboardPayload,
+            widget = self._widgetPayload,
+            visualization = self._visualizationPayload,
+        )[objecttype]
+        return builder(filename)
+
+    def plan(self, *filenames):
+        """Prints, field by field, what uploading the files
+        would change in the server, without changing anything.
+        """
+        graph = self.dependencies(*self._roots(filenames))
+        self._fetchRemote(graph)
+        counts = Counter()
+        for objecttype, filename in graph:
+            id = self.mapper.remoteId(objecttype, filename)
+            if objecttype == 'datasource':
+                if not id:
+                    self.warn("Data source {} is not bound", filename)
+                continue
+            if not id:
+                out("+ create {} {}", objecttype, filename)
+                counts['create'] += 1
+                continue
+            remote = self._remoteFields(objecttype, id)
+            if remote is None:
+                out("! {} {} bound to {} missing in the server", objecttype, filename, id)
+                counts['missing'] += 1
+                continue
+            payload = _plain(self._payload(objecttype, filename))
+            changes = [
+                change
+                for key in payload
+                if key in remote
+                for change in _fieldChanges(remote[key], payload[key], key)
+            ]
+            if not changes:
+                counts['unchanged'] += 1
+                continue
+            counts['update'] += 1
+            out("~ update {} {} ({})", objecttype, filename, id)
+            for field, old, new in changes:
+                out("    {}", _formatChange(field, old, new))
+        step("Plan: {} to create, {} to update, {} unchanged, {} missing",
+            counts['create'], counts['update'], counts['unchanged'], counts['missing'])
+        step(self.redash.summary())
+
+    def _dashboardPayload(self, filename):
+        dashboard = self._content(filename)
+        return {
             param: dashboard[param]
             for param in [
                 "slug",
@@ -264,43 +765,63 @@ class Uploader(object):
             ]
             if param in dashboard
         }
-        if params:
-            self.redash.update_dashboard(dashboardId, params)
 
-        for widgetfile in filename.glob('widgets/*.yaml'):
-            self.uploadWidget(widgetfile)
+    def _send(self, objecttype, id, payload, update):
+        "Updates the object with the payload, or just what the plan changes"
+        changes = self._planned(objecttype, id, payload)
+        if not changes:
+            self.step("Unchanged {} {}", objecttype, id)
+            return
+        update(id, changes)
 
-        return dashboardId
+    def uploadDashboard(self, filename):
+        dashboard = self._content(filename)
 
-    @level('widget')
-    def uploadWidget(self, filename):
+        dashboardId = self.mapper.remoteId('dashboard', filename)
+        if not dashboardId:
+            dashboardId = ns(self.redash.create_dashboard(dashboard.name)).id
+            self.mapper.bind('dashboard', dashboardId, filename)
+            self.step("Created a new dashboard {}", dashboardId)
 
-        widget = ns.load(filename)
+        params = self._dashboardPayload(filename)
+        if params and not self._unchanged(filename, dashboardId, params):
+            self._send('dashboard', dashboardId, params, self.redash.update_dashboard)
+            self._remember(filename, dashboardId, params)
+
+        return dashboardId
+
+    def _widgetPayload(self, filename):
+        widget = self._content(filename)
         dashboardPath = parentObjectPath(filename)
-        dashboardId = self.uploadDashboard(dashboardPath)
+        dashboardId = self.mapper.remoteId('dashboard', dashboardPath)
 
         visId = (
-            self.uploadVisualization(widget.visualization)
-            if 'visualization' in widget else None
+            self.mapper.remoteId('visualization', widget.visualization)
+            if widget.get('visualization') else None
         )
-        widgetId = self.mapper.remoteId('widget', filename)
-        params = ns(
+        return ns(
             dashboard_id = dashboardId,
             visualization_id = visId,
             text = widget.text,
             width = widget.width,
             options = widget.options,
         )
+
+    def uploadWidget(self, filename):
+        widgetId = self.mapper.remoteId('widget', filename)
+        params = self._widgetPayload(filename)
         if widgetId:
-            self.redash.update_widget(widgetId, params)
+            if not self._unchanged(filename, widgetId, params):
+                self._send('widget', widgetId, params, self.redash.update_widget)
+                self._remember(filename, widgetId, params)
         else:
             newwidget = ns(self.redash.create_widget(**params))
             widgetId = newwidget.id
             self.mapper.bind('widget', widgetId, filename)
+            self._remember(filename, widgetId, params)
 
         return widgetId
 
-    @level('datasource')
     def uploadDataSource(self, filename):
         dataSourceId = self.mapper.remoteId('datasource', filename)
         if dataSourceId: return dataSourceId
@@ -325,12 +846,17 @@ class Uploader(object):
             )
         )
 
-    @level('query')
-    def uploadQuery(self, filename):
-        query = ns.load(filename/'metadata.yaml')
-        query.query = _read(filename/'query.sql')
-        dataSourceId = self.uploadDataSource(query.data_source_id)
-        queryId = self.mapper.remoteId('query', filename)
+    def _queryPayload(self, filename):
+        "Returns the query creation parameters and the ones set after"
+        query = self._content(filename)
+        dataSourceId = (
+            self.mapper.remoteId('datasource', query.data_source_id)
+            if query.get('data_source_id') else None
+        )
+        options = copy.deepcopy(query.options)
+        for parameter in options.get('parameters', []):
+            if 'queryId' in parameter:
+                parameter.queryId = self.mapper.remoteId('query', parameter.queryId)
         params = ns(
             name = query.name,
             description = query.description,
@@ -339,30 +865,30 @@ class Uploader(object):
             schedule = query.schedule,
             is_archived = query.is_archived,
             is_draft = query.is_draft,
-            options = query.options,
+            options = options,
         )
-
-        for parameter in query.options.get('parameters', []):
-            if 'queryId' in parameter:
-                parameter.queryId = self.uploadQuery(parameter.queryId)
-        if queryId:
-            self.redash.update_query(queryId, params)
-        else:
-            remotequery = ns(self.redash.create_query(**params))
-            queryId = remotequery.id
-            self.mapper.bind('query', queryId, filename)
-
-            defaultView = remotequery.visualizations[0]['id']
-            self.unboundDefaultVisualization(filename, defaultView)
-
-        self.redash.update_query(queryId, ns(
+        tags = ns(
             tags = query.tags,
             is_draft = query.is_draft,
-        ))
-
+        )
+        return params, tags
 
-        for visualizationfile in filename.glob('visualizations/*.yaml'):
-            visId = self.uploadVisualization(visualizationfile)
+    def uploadQuery(self, filename):
+        queryId = self.mapper.remoteId('query', filename)
+        params, tags = self._queryPayload(filename)
+        if not queryId or not self._unchanged(filename, queryId, params, tags):
+            if queryId:
+                self._send('query', queryId, ns(params, **tags), self.redash.update_query)
+            else:
+                remotequery = ns(self.redash.create_query(**params))
+                queryId = remotequery.id
+                self.mapper.bind('query', queryId, filename)
+
+                defaultView = remotequery.visualizations[0]['id']
+                self.unboundDefaultVisualization(filename, defaultView)
+                # Creation ignores tags
+                self.redash.update_query(queryId, tags)
+            self._remember(filename, queryId, params, tags)
 
         return queryId
 
@@ -380,78 +906,458 @@ class Uploader(object):
             )
         return visId
 
-    @level('visualization')
-    def uploadVisualization(self, filename):
+    def _visualizationPayload(self, filename):
         queryfile = parentObjectPath(filename)
-        queryId = self.uploadQuery(queryfile)
+        visualization = self._content(filename)
+        return ns(
+            query_id = self.mapper.remoteId('query', queryfile),
+            name = visualization.name,
+            description = visualization.description,
+            type = visualization.type,
+            options = visualization.options,
+        )
 
-        visualization = ns.load(filename)
+    def uploadVisualization(self, filename):
+        visualization = self._content(filename)
         visId = self.mapper.remoteId('visualization', filename)
 
         # Bind the default created visualization
         if not visId and visualization.type == 'TABLE':
             visId = self.bindDefaultVisualization(filename)
 
-        params = ns(
-            query_id = queryId,
-            name = visualization.name,
-            description = visualization.description,
-            type = visualization.type,
-            options = visualization.options,
-        )
+        params = self._visualizationPayload(filename)
 
         if not visId:
             visId = ns(self.redash.create_visualization(**params)).id
             self.mapper.bind('visualization', visId, filename)
-        else:
-            self.redash.update_visualization(visId, **params)
+            self._remember(filename, visId, params)
+        elif not self._unchanged(filename, visId, params):
+            self._send('visualization', visId, params,
+                lambda id, changes: self.redash.update_visualization(id, **changes))
+            self._remember(filename, visId, params)
 
         return visId
 
 
-def uploadFile(servername, *filenames):
-    uploader = Uploader(servername)
+def _objectTree(bundle):
+    "Where to read the file objects from, a bundle file or the working directory"
+    return BundleTree(bundle) if bundle else None
+
+def uploadFile(servername, *filenames, force=False, jobs=1, fromPlan=False, affectedBy=(), bundle=None):
+    """Uploads the file objects and, for every object in `affectedBy`,
+    the object itself and the ones using it.
+    Objects are read from the `bundle` file if given."""
+    if affectedBy and bundle:
+        fail("Objects affected by others are found just in the working directory, not in bundles")
+    if affectedBy:
+        index = repoIndex()
+        objects = [objectPath(filename) for filename in affectedBy]
+        # Data sources are not uploaded, just the objects using them
+        affected = sorted(
+            path for path in index.dependants(*objects) | set(objects)
+            if _path2type(Path(path)) in Uploader.handlers
+        )
+        step("Objects affected by {}: {}", ', '.join(objects), len(affected))
+        filenames = filenames + tuple(affected)
+    uploader = Uploader(servername, force=force, jobs=jobs, fromPlan=fromPlan,
+        tree=_objectTree(bundle))
     uploader.upload(*filenames)
 
-def checkoutAll(servername):
-    Downloader(servername).checkoutAll()
+def watchUploads(servername, *paths, jobs=1, interval=0.2, debounce=0.3):
+    """Uploads the file objects under paths as they change,
+    keeping the same uploader, with its map and connections,
+    until interrupted"""
+    uploader = Uploader(servername, jobs=jobs)
+    watcher = createWatcher(paths or ('queries', 'dashboards'),
+        interval=interval, debounce=debounce)
+    if watcher.polling and not paths:
+        warn("Polling every query and dashboard file. On large repositories, "
+            "install watchdog to be notified of changes instead, "
+            "or give just the paths you are editing.")
+    paths = watcher.paths
+    step("Watching {} to upload changes to {}. Press Ctrl-C to stop.",
+        ', '.join(map(str, paths)), uploader.servername)
+    try:
+        for changed in watcher.changes():
+            objects = set()
+            for filename in sorted(changed):
+                if not os.path.exists(filename):
+                    warn("Removed {}, not removed in the server", filename)
+                    continue
+                objectpath = Path(objectPath(filename))
+                if _path2type(objectpath) in uploader.handlers:
+                    objects.add(objectpath)
+            if not objects: continue
+            start = time.perf_counter()
+            try:
+                uploader.uploadChanged(*sorted(objects))
+            except SystemExit:
+                continue # failures already explained
+            except Exception as exception:
+                warn("Upload failed: {}", exception)
+                continue
+            step("Uploaded {} in {:.0f}ms", ', '.join(map(str, sorted(objects))),
+                (time.perf_counter() - start)*1000)
+    except KeyboardInterrupt:
+        pass
+    step(uploader.redash.summary())
+
+def repoIndex():
+    "The up to date index of the file objects in the current directory"
+    return RepoIndex(Path('.'), configfile.parent/'index.json').load()
+
+def objectPath(filename):
+    "The path that identifies a file object given any of its files"
+    filename = Path(filename)
+    if filename.name in ('metadata.yaml', 'query.sql'):
+        filename = filename.parent
+    return str(filename)
+
+def syncServers(source, target, selector=None, jobs=1, checkout=False):
+    """Uploads to the target server the selected queries and dashboards
+    of the source server, and the queries they use, without files
+    in between: each object is uploaded as soon as it is fetched
+    and the ones it requires are uploaded. Both servers maps
+    relate the objects through their paths.
+    Files are written just with `checkout`, at the end.
+    """
+    tree = MemoryTree()
+    downloader = Downloader(source, jobs=jobs, selector=selector)
+    uploader = Uploader(target, jobs=jobs, tree=tree)
+    if downloader.servername == uploader.servername:
+        fail("Cannot sync server '{}' with itself".format(source))
+    try:
+        uploader.uploadStream(downloader.stream(tree))
+        if checkout:
+            downloader.checkoutTree(tree)
+    finally:
+        downloader.mapper.flush()
+    if checkout:
+        step("Files written: {written}, unchanged: {unchanged}",
+            written=writeStats['written'],
+            unchanged=writeStats['unchanged'],
+        )
+    step("{}: {}", downloader.servername, downloader.redash.summary())
+    step("{}: {}", uploader.servername, uploader.redash.summary())
+
+def planUpload(servername, *filenames, jobs=1, bundle=None):
+    Uploader(servername, jobs=jobs, tree=_objectTree(bundle)).plan(*filenames)
+
+# What bundles hold unless told otherwise
+bundleRoots = ('datasources', 'queries', 'dashboards', 'maps')
+
+def _relativePath(path):
+    "Normalized path, failing if out of the working directory"
+    path = Path(os.path.normpath(str(path)))
+    if path.is_absolute() or path.parts[:1] == ('..',):
+        fail("{} is out of the working directory".format(path))
+    return path
+
+def _isWithin(path, prefixes):
+    return any(path == prefix or prefix in path.parents for prefix in prefixes)
+
+def _bundledFiles(paths):
+    "Yields, sorted, the files under paths but the hidden ones"
+    for path in paths:
+        if path.is_file():
+            yield path
+            continue
+        for directory, subdirs, files in os.walk(str(path)):
+            subdirs[:] = sorted(name for name in subdirs if not name.startswith('.'))
+            for name in sorted(files):
+                if name.startswith('.'): continue
+                yield Path(directory, name)
+
+def exportBundle(bundlefile, *paths):
+    """Packs the files under paths, the file objects and maps by default,
+    into bundlefile"""
+    for path in paths:
+        if not Path(path).exists():
+            fail("{} not found".format(path))
+    paths = [_relativePath(path) for path in paths or bundleRoots]
+    with BundleWriter(bundlefile) as bundle:
+        for filename in _bundledFiles(paths):
+            with span('bundle', 'files', file=str(filename)):
+                bundle.addFile(filename, filename)
+    step("Bundled {} files into {}, {} bytes",
+        len(bundle.table), bundlefile, bundle.offset)
+
+def importBundle(bundlefile, *paths):
+    """Writes the files in bundlefile, just the ones under paths if given,
+    into the working directory, leaving alone the ones already there"""
+    prefixes = [_relativePath(path) for path in paths]
+    bundle = BundleTree(bundlefile)
+    stats = Counter()
+    for path in bundle.paths():
+        filename = _relativePath(path)
+        if prefixes and not _isWithin(filename, prefixes):
+            continue
+        with span('write', 'files', file=path):
+            written = writeIfChanged(filename, bundle.bytes(path))
+        stats['written' if written else 'unchanged'] += 1
+    step("Files written: {written}, unchanged: {unchanged}",
+        written=stats['written'],
+        unchanged=stats['unchanged'],
+    )
+
+def checkoutAll(servername, jobs=1, incremental=False, selector=None, only=None,
+        withResults=False, resultsMaxSize=None, gitCommit=False, gitBranch=None):
+    Downloader(servername,
+        jobs=jobs,
+        incremental=incremental,
+        selector=selector,
+        withResults=withResults,
+        resultsMaxSize=resultsMaxSize,
+        gitCommit=gitCommit,
+        gitBranch=gitBranch,
+    ).checkoutAll(only=only)
     
-def checkoutQuery(servername, queryId):
-    Downloader(servername).checkoutQuery(queryId)
+def checkoutQuery(servername, queryId, withResults=False, resultsMaxSize=None):
+    Downloader(servername,
+        withResults=withResults,
+        resultsMaxSize=resultsMaxSize,
+    ).checkoutQuery(queryId)
+
+def checkoutDashboard(servername, idOrSlug, jobs=1, withResults=False, resultsMaxSize=None):
+    Downloader(servername,
+        jobs=jobs,
+        withResults=withResults,
+        resultsMaxSize=resultsMaxSize,
+    ).checkoutDashboard(idOrSlug)
+
+class Selector(object):
+    """Chooses queries and dashboards from their listing summary.
+    All given criteria must be met:
+    having any of `tags`, updated at or after `since`,
+    a name matching `nameglob`, and, when any id is given,
+    having one of `queryIds` or `dashboardIds`, by type,
+    since Redash numbers queries and dashboards independently.
+    """
+    def __init__(self, tags=(), since=None, queryIds=(), dashboardIds=(), nameglob=None):
+        self.tags = set(tags)
+        self.since = since
+        if since and since.tzinfo is None:
+            self.since = since.replace(tzinfo=timezone.utc)
+        self.ids = dict(
+            query=set(queryIds),
+            dashboard=set(dashboardIds),
+        )
+        self.nameglob = nameglob
+
+    def __bool__(self):
+        return bool(self.tags or self.since or self._byId() or self.nameglob)
+
+    def _byId(self):
+        return any(self.ids.values())
+
+    def _updatedSince(self, summary):
+        try:
+            updated = datetime.fromisoformat(summary['updated_at'])
+        except (KeyError, TypeError, ValueError):
+            return True # unknown, better included
+        if updated.tzinfo is None:
+            updated = updated.replace(tzinfo=timezone.utc)
+        return updated >= self.since
+
+    def matches(self, type, summary):
+        if self._byId() and summary['id'] not in self.ids[type]:
+            return False
+        if self.tags and not self.tags.intersection(summary.get('tags') or []):
+            return False
+        if self.nameglob and not fnmatch(summary.get('name') or '', self.nameglob):
+            return False
+        if self.since and not self._updatedSince(summary):
+            return False
+        return True
 
 class Downloader(object):
-    def __init__(self, servername):
+    """Retrieves server objects into file objects.
+
+    Up to `jobs` objects are fetched concurrently, but files
+    are written and bound in the same order as a sequential run,
+    so the result does not depend on the number of jobs.
+
+    The last seen `updated_at` and `version` of every query and
+    dashboard are kept in a per server state file, out of the tree.
+    When `incremental` is set, objects whose listing summary
+    matches that state are neither fetched nor written.
+    Redash does not bump the summary of a query or a dashboard
+    when just its visualizations or widgets change,
+    so those changes wait for a full checkout.
+
+    Likewise, just the queries and dashboards whose summary
+    matches the `selector`, if any, are fetched and written.
+
+    With `withResults`, the latest result of every query checked out
+    is streamed into its folder, up to `resultsMaxSize` bytes,
+    unless it is the same result downloaded last time.
+
+    With `gitCommit`, files are not written into the working tree
+    but committed, along with the map, to the current git branch
+    or `gitBranch`, through git fast-import.
+    """
+    def __init__(self, servername, jobs=1, incremental=False, selector=None,
+            withResults=False, resultsMaxSize=None, gitCommit=False, gitBranch=None):
         config = serverConfig(servername)
         self.servername = config.name # param might be None, this solves
-        self.redash = Redash(config.url, config.apikey)
+        self.jobs = jobs
+        self.incremental = incremental
+        self.selector = selector
+        self.withResults = withResults
+        self.resultsMaxSize = resultsMaxSize or 10*1024*1024
+        self.pendingResults = []
+        self.redash = connect(config, poolsize=jobs)
         self.repopath = Path('.')
-        self.mapper = Mapper(self.repopath, config.name)
+        self.mapper = createMapper(self.repopath, config)
+        self.statefile = configfile.parent/'state'/'{}.json'.format(config.name)
+        self._state = None
+        self.git = None
+        if gitCommit:
+            if withResults:
+                fail("Query results cannot be committed to git, just checked out")
+            self.git = GitCommit(self.repopath, gitBranch)
+            self.mapper.listdir = self.git.names
+
+    def _loadState(self):
+        if self._state is not None:
+            return self._state
+        self._state = loadJson(self.statefile)
+        return self._state
+
+    def _saveState(self):
+        if self._state is None:
+            return
+        dumpJson(self.statefile, self._state)
+
+    @staticmethod
+    def _revision(anObject):
+        return [anObject.get('updated_at'), anObject.get('version')]
+
+    def _remember(self, type, anObject):
+        "Records the revision of an object just checked out"
+        objects = self._loadState().setdefault(type, {})
+        objects[str(anObject['id'])] = self._revision(anObject)
+
+    def _unchanged(self, type, summary, filename):
+        "Whether the summary matches the revision last checked out into filename"
+        if not self.incremental:
+            return False
+        revision = self._revision(summary)
+        if revision == [None, None]:
+            return False
+        objects = self._loadState().get(type, {})
+        if objects.get(str(summary['id'])) != revision:
+            return False
+        path = self.mapper.get(type, summary['id'])
+        return bool(path) and self._exists(Path(path)/filename)
+
+    def _exists(self, filename):
+        if self.git:
+            return self.git.exists(filename)
+        return filename.exists()
+
+    def _writeFile(self, filename, content):
+        "Writes a file, or adds it to the git commit, if changed"
+        with span('write', 'files', file=str(filename)) as traced:
+            if self.git:
+                written = self.git.add(filename, content)
+            else:
+                filename.parent.mkdir(exist_ok=True, parents=True)
+                written = writeIfChanged(filename, content)
+            traced.update(written=written)
+        writeStats['written' if written else 'unchanged'] += 1
+
+    def _dump(self, filename, content):
+        print(_fileType(filename), filename)
+        content = _fileContent(filename, content)
+        with span('dump', 'yaml', file=str(filename)):
+            serialized = dumpYaml(content)
+        self._writeFile(filename, serialized)
+
+    def _write(self, filename, content):
+        print(_path2type(filename), filename)
+        self._writeFile(filename, content)
+
+    def _changed(self, type, summaries, filename):
+        """Filters out the summaries of unchanged or unselected objects,
+        counting them"""
+        skipped = 0
+        unselected = 0
+        for summary in summaries:
+            if self.selector and not self.selector.matches(type, summary):
+                unselected += 1
+                continue
+            if self._unchanged(type, summary, filename):
+                skipped += 1
+                continue
+            yield summary
+        if unselected:
+            step("Skipped {} not selected {} objects", unselected, type)
+        if skipped:
+            step("Skipped {} unchanged {} objects", skipped, type)
 
     def checkoutDataSources(self):
-        datasourcespath = self.repopath / 'datasources'
-        datasourcespath.mkdir(exist_ok=True)
-
-        for datasource in self.redash.datasources():
-            step("Exporting data source: {id} - {name}", **datasource)
-            datasource = ns(self.redash.datasource(datasource['id'])) # full content
-            datasourcepath = self.mapper.track('datasource', datasourcespath, datasource, suffix='.yaml')
-            _dump(datasourcepath, datasource)
+        fullDataSources = fetchInOrder(
+            lambda datasource: self.redash.datasource(datasource['id']),
+            self.redash.datasources(),
+            self.jobs,
+        )
+        for datasource in fullDataSources:
+            self._checkoutDataSource(datasource)
+
+    def _checkoutDataSource(self, datasource):
+        datasource = ns(datasource)
+        step("Exporting data source: {id} - {name}", **datasource)
+        datasourcepath = self.mapper.track('datasource', self.repopath/'datasources', datasource, suffix='.yaml')
+        self._dump(datasourcepath, datasource)
+
+    def summary(self):
+        step("Files written: {written}, unchanged: {unchanged}",
+            written=writeStats['written'],
+            unchanged=writeStats['unchanged'],
+        )
+        step(self.redash.summary())
 
     def checkoutQuery(self, queryId):
-        datasourcespath = self.repopath / 'datasources'
-        if not datasourcespath.exists():
-            self.checkoutDataSources()
-        queriespath = self.repopath / 'queries'
-        queriespath.mkdir(exist_ok=True)
-        self._checkoutQuery(queryId)
+        writeStats.clear()
+        try:
+            datasourcespath = self.repopath / 'datasources'
+            if not datasourcespath.exists():
+                self.checkoutDataSources()
+            query = self.redash.query(queryId)
+            self._checkoutQuery(query)
+            self._remember('query', query)
+            self._checkoutResults()
+        finally:
+            self.mapper.flush()
+            self._saveState()
+        self.summary()
 
-    def _checkoutQuery(self, queryId):
-        query = ns(self.redash.query(queryId))
+    def _checkoutQuery(self, query):
+        query = ns(query)
         step("Exporting query: {id} - {name}", **query)
-        
+        # dumping cleans them up
+        queryId, resultId = query.id, query.get('latest_query_data_id')
+
+        querypath, files = self._queryFiles(query)
+        for filename, content in files:
+            if isinstance(content, str):
+                self._write(filename, content)
+                continue
+            if _fileType(filename) == 'visualization':
+                step("Exporting visualization {id} {type} {name}", **content)
+            self._dump(filename, content)
+
+        if self.withResults and resultId:
+            self.pendingResults.append((queryId, resultId, querypath))
+
+        return (query, querypath)
+
+    def _queryFiles(self, query):
+        """Returns the folder of a server query and its files, as
+        (filename, content), referring other objects by path"""
         querypath = self.mapper.track('query', self.repopath/'queries', query)
-        querypath.mkdir(parents=True, exist_ok=True)
-        
+
         query_text = query.get('query', None)
         visualizations = query.get('visualizations',[])
         datasource_id = query.get('data_source_id', None)
@@ -459,67 +1365,330 @@ class Downloader(object):
         if datasource_id:
             datasourcepath = self.mapper.get('datasource', datasource_id)
             if not datasourcepath:
-                warn("Query refers missing data source '{}'". datasource_id)
+                warn("Query refers missing data source '{}'", datasource_id)
             query.data_source_id = datasourcepath
-             
-        if query_text is not None:
-            _write(querypath/'query.sql', query_text)
 
-        _dump(querypath/'metadata.yaml', query)
-        
+        # Parameter queries not checked out yet are resolved by checkoutQueries
+        for parameter in query.get('options', {}).get('parameters', []):
+            if 'queryId' not in parameter: continue
+            parameterQuery = self.mapper.get('query', parameter['queryId'])
+            if parameterQuery:
+                parameter['queryId'] = parameterQuery
+
+        files = []
+        if query_text is not None:
+            files.append((querypath/'query.sql', query_text))
+        files.append((querypath/'metadata.yaml', query))
         for vis in visualizations:
             vis = ns(vis)
-            step("Exporting visualization {id} {type} {name}", **vis)
             vispath = self.mapper.track('visualization', querypath/'visualizations', vis, suffix='.yaml')
-            _dump(vispath, vis)
-            
-        return (query, querypath)
+            files.append((vispath, vis))
+        return querypath, files
+
+    def _checkoutResults(self):
+        """Downloads the results of the queries checked out so far
+        but the ones already downloaded"""
+        pending, self.pendingResults = self.pendingResults, []
+        downloaded = self._loadState().setdefault('results', {})
+        changed = [
+            (queryId, resultId, querypath)
+            for queryId, resultId, querypath in pending
+            if downloaded.get(str(queryId)) != resultId
+            or not (querypath/'results.ndjson').exists()
+        ]
+        if len(changed) < len(pending):
+            step("Skipped {} unchanged query results", len(pending) - len(changed))
+
+        def download(job):
+            queryId, resultId, querypath = job
+            with span('results', 'results', query=queryId) as traced:
+                result = downloadQueryResult(
+                    self.redash.query_result(resultId),
+                    querypath,
+                    self.resultsMaxSize,
+                )
+                traced.update(rows=result.rows, bytes=result.bytes)
+            return result
+
+        results = fetchInOrder(download, changed, self.jobs)
+        for (queryId, resultId, querypath), result in zip(changed, results):
+            step("Exported {} result rows of query {}", result.rows, queryId)
+            if result.truncated:
+                warn("Results of query {} truncated at {} bytes", queryId, self.resultsMaxSize)
+            writeStats['written'] += len(result.written)
+            writeStats['unchanged'] += len(result.unchanged)
+            downloaded[str(queryId)] = resultId
 
     def checkoutQueries(self):
-        queriespath = self.repopath / 'queries'
-        queriespath.mkdir(exist_ok=True)
-
         toreview = []
 
-        for query in self.redash.queries():
-            query, querypath = self._checkoutQuery(query['id'])
+        fullQueries = fetchInOrder(
+            lambda query: self.redash.query(query['id']),
+            self._changed('query', self.redash.queries(), 'metadata.yaml'),
+            self.jobs,
+        )
+        for fullQuery in fullQueries:
+            query, querypath = self._checkoutQuery(fullQuery)
+            self._remember('query', fullQuery)
 
             for parameter in query.get('options', {}).get('parameters', []):
                 if 'queryId' not in parameter: continue
-                toreview.append(querypath/'metadata.yaml')
+                if isinstance(parameter['queryId'], str): continue
+                toreview.append((querypath/'metadata.yaml', query))
+                break
+
+        # Parameter queries left out of the selection
+        self._checkoutMissingQueries(
+            id
+            for queryMetaFile, query in toreview
+            for id in _parameterQueryIds(query)
+            if not self.mapper.get('query', id)
+        )
 
-        for queryMetaFile in toreview:
-            query = ns.load(queryMetaFile)
+        # Dumped queries are already cleaned up, no need to read them back
+        for queryMetaFile, query in toreview:
             for parameter in query.get('options', {}).get('parameters', []):
                 if 'queryId' not in parameter: continue
-                parameter.queryId = self.mapper.get('query', parameter.queryId)
-            _dump(queryMetaFile, query)
+                if isinstance(parameter['queryId'], str): continue
+                queryId = parameter['queryId']
+                parameter['queryId'] = self.mapper.get('query', queryId) or queryId
+                if parameter['queryId'] == queryId:
+                    warn("{} refers to query {}, not checked out, kept by id",
+                        queryMetaFile, queryId)
+            self._dump(queryMetaFile, query)
 
-    def checkoutDashboards(self):
-        status = ns(self.redash.status())
-        dashboard_with_slugs = version.parse(status.version) < version.parse('9-alpha')
-
-        for dashboard in self.redash.dashboards():
-            step("Exporting dashboard: {slug} - {name}", **dashboard)
-            idfield = 'slug' if dashboard_with_slugs else 'id'
-            dashboard = ns(self.redash.dashboard(dashboard[idfield]))
-            dashboardpath = self.mapper.track('dashboard', self.repopath/'dashboards', dashboard)
-            widgets = dashboard.get('widgets',[])
-            _dump(dashboardpath/'metadata.yaml', dashboard)
-            for widget in widgets:
-                widget = ns(widget)
-                widgetpath = self.mapper.track('widget', dashboardpath/'widgets', widget, suffix='.yaml')
-                vis = widget.get('visualization', None)
-                if vis:
-                    widget.visualization = self.mapper.get('visualization', vis['id'])
-                _dump(widgetpath, widget)
-
-    def checkoutAll(self):
-        self.checkoutDataSources()
-        self.checkoutQueries()
-        self.checkoutDashboards()
+        self._checkoutResults()
 
+    def checkoutDashboards(self):
+        idfield = _dashboardIdField(self.redash)
 
+        fullDashboards = fetchInOrder(
+            lambda dashboard: self.redash.dashboard(dashboard[idfield]),
+            self._changed('dashboard', self.redash.dashboards(), 'metadata.yaml'),
+            self.jobs,
+        )
+        for fullDashboard in fullDashboards:
+            # Queries behind widgets left out of the selection
+            self._checkoutMissingQueries(
+                widget['visualization']['query']['id']
+                for widget in fullDashboard.get('widgets', [])
+                if widget.get('visualization')
+                and not self.mapper.get('visualization', widget['visualization']['id'])
+            )
+            self._checkoutDashboard(fullDashboard)
+        self._checkoutResults()
+
+    def _checkoutDashboard(self, fullDashboard):
+        dashboard = ns(fullDashboard)
+        step("Exporting dashboard: {slug} - {name}", **dashboard)
+        dashboardpath, files = self._dashboardFiles(dashboard)
+        for filename, content in files:
+            self._dump(filename, content)
+        self._remember('dashboard', fullDashboard)
+
+    def _dashboardFiles(self, dashboard):
+        """Returns the folder of a server dashboard and its files, as
+        (filename, content), referring visualizations by path"""
+        dashboardpath = self.mapper.track('dashboard', self.repopath/'dashboards', dashboard)
+        widgets = dashboard.get('widgets',[])
+        files = [(dashboardpath/'metadata.yaml', dashboard)]
+        for widget in widgets:
+            widget = ns(widget)
+            widgetpath = self.mapper.track('widget', dashboardpath/'widgets', widget, suffix='.yaml')
+            vis = widget.get('visualization', None)
+            if vis:
+                widget.visualization = self.mapper.get('visualization', vis['id'])
+                if not widget.visualization:
+                    warn("{} shows visualization {}, not checked out, kept by id",
+                        widgetpath, vis['id'])
+                    widget.visualization = vis['id']
+            files.append((widgetpath, widget))
+        return dashboardpath, files
+
+    def _dashboardKey(self, idOrSlug):
+        "The id or the slug of a dashboard, whichever the server expects"
+        idfield = _dashboardIdField(self.redash)
+        if str(idOrSlug).isdigit() == (idfield == 'id'):
+            return idOrSlug
+        for summary in self.redash.dashboards():
+            if str(summary['id']) == str(idOrSlug) or summary['slug'] == idOrSlug:
+                return summary[idfield]
+        fail("Dashboard '{}' not found".format(idOrSlug))
+
+    def _fetchQueries(self, queryIds, known=None):
+        """Fetches the queries and, level by level, their parameter
+        queries, each one once, but the parameter queries `known`
+        tells to leave out. Returns them by id."""
+        return {
+            query['id']: query
+            for query in self._streamQueries(queryIds, known)
+        }
 
+    def _streamQueries(self, queryIds, known=None):
+        """Like _fetchQueries, but yields the queries as they arrive"""
+        seen = set()
+        pending = list(dict.fromkeys(queryIds))
+        while pending:
+            seen.update(pending)
+            following = []
+            for query in fetchInOrder(self.redash.query, pending, self.jobs):
+                # Read before yielding, consumers turn the ids into paths
+                following.extend(
+                    id for id in _parameterQueryIds(query)
+                    if id not in seen and not (known and known(id))
+                )
+                yield query
+            pending = list(dict.fromkeys(following))
+
+    def _checkoutQueries(self, queries):
+        "Checks out fetched queries, binding them all first"
+        # Bound beforehand so that parameter queries resolve to paths
+        queriespath = self.repopath / 'queries'
+        for query in queries:
+            self.mapper.track('query', queriespath, ns(query))
+        for query in queries:
+            self._checkoutQuery(query)
+            self._remember('query', query)
+
+    def _checkoutMissingQueries(self, queryIds):
+        """Checks out the queries with those ids, needed by the ones
+        checked out, and the parameter queries they use not checked out yet"""
+        queries = self._fetchQueries(queryIds,
+            known=lambda id: self.mapper.get('query', id))
+        if not queries: return
+        step("Exporting {} queries the selected objects use", len(queries))
+        self._checkoutQueries(list(queries.values()))
+
+    def checkoutDashboard(self, idOrSlug):
+        """Checks out a dashboard and just the objects it depends on:
+        the queries behind its widgets, their parameter queries
+        and their data sources.
+        """
+        writeStats.clear()
+        try:
+            fullDashboard = self.redash.dashboard(self._dashboardKey(idOrSlug))
+            queries = self._fetchQueries(
+                widget['visualization']['query']['id']
+                for widget in fullDashboard.get('widgets', [])
+                if widget.get('visualization')
+            )
+            datasources = fetchInOrder(
+                self.redash.datasource,
+                sorted(set(
+                    query['data_source_id']
+                    for query in queries.values()
+                    if query.get('data_source_id')
+                )),
+                self.jobs,
+            )
+            for datasource in datasources:
+                self._checkoutDataSource(datasource)
 
+            self._checkoutQueries(list(queries.values()))
+            self._checkoutResults()
 
+            self._checkoutDashboard(fullDashboard)
+        finally:
+            self.mapper.flush()
+            self._saveState()
+        self.summary()
+
+    def stream(self, tree):
+        """Fetches the selected queries and dashboards, the queries
+        the dashboards use and their parameter queries, putting their
+        files into `tree` instead of the working directory.
+        Yields ('query' or 'dashboard', path) as soon as each object
+        is in the tree, queries before the parameter queries
+        they use are in but after they are bound, and dashboards last.
+        """
+        for datasource in self.redash.datasources():
+            self.mapper.track('datasource', self.repopath/'datasources',
+                ns(datasource), suffix='.yaml')
+
+        idfield = _dashboardIdField(self.redash)
+        dashboards = list(fetchInOrder(
+            lambda dashboard: self.redash.dashboard(dashboard[idfield]),
+            self._changed('dashboard', self.redash.dashboards(), 'metadata.yaml'),
+            self.jobs,
+        ))
+        queryIds = [
+            query['id']
+            for query in self._changed('query', self.redash.queries(), 'metadata.yaml')
+        ] + [
+            widget['visualization']['query']['id']
+            for dashboard in dashboards
+            for widget in dashboard.get('widgets', [])
+            if widget.get('visualization')
+        ]
+
+        def put(files):
+            for filename, content in files:
+                if not isinstance(content, str):
+                    content = ns.deep(_fileContent(filename, content))
+                tree.put(filename, content)
+
+        def bound(query):
+            return all(self.mapper.get('query', id) for id in _parameterQueryIds(query))
+
+        # Queries wait for their parameter queries to be bound
+        held = []
+        for query in self._streamQueries(queryIds):
+            self.mapper.track('query', self.repopath/'queries', ns(query))
+            self._remember('query', query)
+            held.append(query)
+            ready = [query for query in held if bound(query)]
+            held = [query for query in held if not bound(query)]
+            for query in ready:
+                querypath, files = self._queryFiles(ns(query))
+                put(files)
+                yield 'query', querypath
+
+        for dashboard in dashboards:
+            dashboardpath, files = self._dashboardFiles(ns(dashboard))
+            put(files)
+            self._remember('dashboard', dashboard)
+            yield 'dashboard', dashboardpath
+
+    def checkoutTree(self, tree):
+        "Writes the files of a tree, and the data sources, into the working directory"
+        writeStats.clear()
+        self.checkoutDataSources()
+        for filename, content in tree.items():
+            if isinstance(content, str):
+                self._write(filename, content)
+            else:
+                self._dump(filename, content)
+        self._saveState()
+
+    def checkoutAll(self, only=None):
+        """Checks out data sources, queries and dashboards,
+        or just the data sources and `only` 'queries' or 'dashboards'.
+        """
+        writeStats.clear()
+        try:
+            self.checkoutDataSources()
+            if only in (None, 'queries'):
+                self.checkoutQueries()
+            if only in (None, 'dashboards'):
+                self.checkoutDashboards()
+            if self.git:
+                self._commit()
+        except BaseException:
+            if self.git:
+                self.git.abort()
+            raise
+        finally:
+            self.mapper.flush()
+            self._saveState()
+        self.summary()
+
+    def _commit(self):
+        "Commits the files added to git, with the map"
+        self.mapper.flush()
+        if not isinstance(self.mapper, SqliteMapper) and self.mapper.mapfile.exists():
+            self._writeFile(self.mapper.mapfile, self.mapper.mapfile.read_bytes())
+        commit = self.git.commit("Checkout of server {}".format(self.servername))
+        if commit:
+            step("Committed {} into branch {}", commit[:12], self.git.branch)
+        else:
+            step("Nothing to commit, branch {} is up to date", self.git.branch)
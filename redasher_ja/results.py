@@ -0,0 +1,160 @@
+# Streaming download of query results into NDJSON files
+
+import os
+import re
+import json
+import codecs
+import filecmp
+from yamlns import namespace as ns
+from .files import writeIfChanged
+from .serialization import dumpYaml
+
+_space = re.compile(r'[ \t\n\r]*')
+_delimiters = set(' \t\n\r,:]}')
+_decoder = json.JSONDecoder()
+
+class JsonReader(object):
+    """Walks a json document arriving in text chunks,
+    decoding just the values asked for, so that memory
+    is bounded by the largest of them, not by the document.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _more(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        "The next non blank character, left unconsumed"
+        while True:
+            self.pos = _space.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._more():
+                raise ValueError("Unexpected end of json document")
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError("Expected {} at json, found {!r}".format(
+                ' or '.join(chars), char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        "Decodes the next value"
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # A number cut by the chunk end looks complete
+                if self.eof or self.buffer[end:end+1] in _delimiters:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._more()
+
+    def keys(self):
+        """Yields the keys of the next object,
+        the caller must read or walk each value before the next key"""
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def items(self):
+        "Yields the decoded items of the next array"
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self._expect(',]') == ']':
+                return
+
+def queryResultRows(chunks, result):
+    """Yields the rows in the text chunks of an api/query_results response,
+    setting result.columns when found, before or after the rows.
+    """
+    reader = JsonReader(chunks)
+    for key in reader.keys():
+        if key != 'query_result':
+            reader.value()
+            continue
+        for key in reader.keys():
+            if key != 'data':
+                reader.value()
+                continue
+            for key in reader.keys():
+                if key == 'rows':
+                    yield from reader.items()
+                elif key == 'columns':
+                    result.columns = reader.value()
+                else:
+                    reader.value()
+
+def _textChunks(response, chunksize=64*1024):
+    decoder = codecs.getincrementaldecoder('utf8')()
+    for chunk in response.iter_content(chunksize):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+def downloadQueryResult(response, folder, maxsize):
+    """Writes the rows of a streamed query result response,
+    one compact json object per line, into folder/results.ndjson,
+    up to maxsize bytes, and the columns, row count and
+    whether it was truncated into folder/results.yaml.
+    Files already with that content are left alone.
+    Returns that summary, along with the bytes of rows and
+    the files `written` and `unchanged`.
+    """
+    result = ns(columns=None, rows=0, truncated=False)
+    rowsfile = folder/'results.ndjson'
+    tmpfile = rowsfile.with_name('.{}.tmp'.format(rowsfile.name))
+    size = 0
+    try:
+        with response, tmpfile.open('wb') as output:
+            for row in queryResultRows(_textChunks(response), result):
+                line = (json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf8')
+                if size + len(line) > maxsize:
+                    result.truncated = True
+                    break
+                output.write(line)
+                size += len(line)
+                result.rows += 1
+        if rowsfile.exists() and filecmp.cmp(str(tmpfile), str(rowsfile), shallow=False):
+            unchanged = [rowsfile]
+        else:
+            os.replace(str(tmpfile), str(rowsfile))
+            unchanged = []
+    finally:
+        if tmpfile.exists():
+            tmpfile.unlink()
+    summaryfile = folder/'results.yaml'
+    if not writeIfChanged(summaryfile, dumpYaml(result)):
+        unchanged.append(summaryfile)
+    result.bytes = size
+    result.unchanged = unchanged
+    result.written = [
+        filename for filename in (rowsfile, summaryfile)
+        if filename not in unchanged
+    ]
+    return result
@@ -0,0 +1,178 @@
+# Fast YAML loading and dumping, equivalent to yamlns
+
+import io
+import re
+import yaml
+from yaml.events import (
+    StreamStartEvent, StreamEndEvent,
+    DocumentStartEvent, DocumentEndEvent,
+    MappingStartEvent, MappingEndEvent,
+    SequenceStartEvent, SequenceEndEvent,
+    ScalarEvent, AliasEvent,
+)
+from yaml.nodes import ScalarNode
+from yamlns import namespace as ns
+from yamlns.serialization import NamespaceYamlDumper, NamespaceYAMLLoader
+
+# Without libyaml, yamlns is used as is
+fast = getattr(yaml, '__with_libyaml__', False)
+
+_strTag = 'tag:yaml.org,2002:str'
+_intTag = 'tag:yaml.org,2002:int'
+_boolTag = 'tag:yaml.org,2002:bool'
+_nullTag = 'tag:yaml.org,2002:null'
+_mergeTag = 'tag:yaml.org,2002:merge'
+_plainInt = re.compile(r'-?(0|[1-9][0-9]*)$')
+
+class _Unsupported(Exception):
+    "The document needs the full yamlns treatment"
+
+_resolver = yaml.resolver.Resolver()
+_resolved = {}
+
+def _resolve(value, implicit):
+    """The tag a scalar gets from its text, as the YAML resolver says.
+    Memoized because keys and small values repeat a lot."""
+    key = value, implicit
+    try:
+        return _resolved[key]
+    except KeyError:
+        pass
+    tag = _resolver.resolve(ScalarNode, value, implicit)
+    if len(value) <= 64:
+        if len(_resolved) > 100000:
+            _resolved.clear()
+        _resolved[key] = tag
+    return tag
+
+def _emit(data, emit, dumper, seen):
+    """Emits the YAML events of data as yamlns representer
+    and serializer would, without building the node tree"""
+    kind = type(data)
+    if kind is str:
+        plain = _resolve(data, (True, False)) == _strTag
+        emit(ScalarEvent(None, _strTag, (plain, True), data,
+            style='|' if '\n' in data else None))
+    elif kind is bool:
+        emit(ScalarEvent(None, _boolTag, (True, False), 'true' if data else 'false'))
+    elif kind is int:
+        emit(ScalarEvent(None, _intTag, (True, False), str(data)))
+    elif data is None:
+        emit(ScalarEvent(None, _nullTag, (True, False), 'null'))
+    elif kind in (ns, dict, list):
+        # Shared containers would be dumped with anchors
+        if id(data) in seen:
+            raise _Unsupported()
+        seen.add(id(data))
+        if kind is list:
+            emit(SequenceStartEvent(None, None, True, flow_style=False))
+            for item in data:
+                _emit(item, emit, dumper, seen)
+            emit(SequenceEndEvent())
+        else:
+            emit(MappingStartEvent(None, None, True, flow_style=False))
+            for key, value in data.items():
+                _emit(key, emit, dumper, seen)
+                _emit(value, emit, dumper, seen)
+            emit(MappingEndEvent())
+    else:
+        # floats, decimals, dates...
+        node = dumper.represent_data(data)
+        if not isinstance(node, ScalarNode):
+            raise _Unsupported()
+        emit(ScalarEvent(None, node.tag, (
+                node.tag == _resolve(node.value, (True, False)),
+                node.tag == _resolve(node.value, (False, True)),
+            ), node.value, style=node.style))
+
+def dumpYaml(data):
+    "YAML text of data, the same ns(data).dump() would write"
+    if not fast:
+        return ns(data).dump()
+    output = io.StringIO()
+    dumper = NamespaceYamlDumper(output,
+        default_flow_style=False,
+        allow_unicode=True,
+    )
+    try:
+        dumper.emit(StreamStartEvent())
+        dumper.emit(DocumentStartEvent(explicit=False))
+        _emit(data, dumper.emit, dumper, set())
+        dumper.emit(DocumentEndEvent(explicit=False))
+        dumper.emit(StreamEndEvent())
+        return output.getvalue()
+    except _Unsupported:
+        pass
+    finally:
+        dumper.dispose()
+    return ns(data).dump()
+
+def _construct(event, loader, anchors):
+    "Builds the value starting at event from the following events"
+    kind = type(event)
+    if kind is ScalarEvent:
+        value = event.value
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = _resolve(value, event.implicit)
+        if tag == _strTag:
+            result = value
+        elif tag == _intTag and _plainInt.match(value):
+            result = int(value)
+        elif tag == _nullTag:
+            result = None
+        elif tag == _boolTag:
+            result = loader.bool_values[value.lower()]
+        elif tag == _mergeTag:
+            raise _Unsupported()
+        else:
+            result = loader.construct_object(
+                ScalarNode(tag, value, style=event.style), deep=True)
+    elif kind is AliasEvent:
+        return anchors[event.anchor]
+    elif event.tag not in (None, '!'):
+        raise _Unsupported()
+    elif kind is MappingStartEvent:
+        result = ns()
+        while True:
+            key = loader.get_event()
+            if type(key) is MappingEndEvent: break
+            key = _construct(key, loader, anchors)
+            result[key] = _construct(loader.get_event(), loader, anchors)
+    elif kind is SequenceStartEvent:
+        result = []
+        while True:
+            item = loader.get_event()
+            if type(item) is SequenceEndEvent: break
+            result.append(_construct(item, loader, anchors))
+    if event.anchor:
+        anchors[event.anchor] = result
+    return result
+
+def loadsYaml(content):
+    "Loads YAML text as ns.loads does"
+    if not fast:
+        return ns.loads(content)
+    loader = NamespaceYAMLLoader(content)
+    try:
+        loader.get_event() # stream start
+        if loader.check_event(StreamEndEvent):
+            return None
+        loader.get_event() # document start
+        result = _construct(loader.get_event(), loader, {})
+        loader.get_event() # document end
+        if not loader.check_event(StreamEndEvent):
+            raise _Unsupported() # let yamlns complain
+        return result
+    except _Unsupported:
+        pass
+    finally:
+        loader.dispose()
+    return ns.loads(content)
+
+def loadYaml(filename):
+    "Loads a YAML file as ns.load does"
+    if not fast:
+        return ns.load(filename)
+    with open(str(filename), encoding='utf8') as f:
+        return loadsYaml(f.read())
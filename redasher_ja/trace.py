@@ -0,0 +1,101 @@
+# Optional tracing of where the time goes
+
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+class Tracer(object):
+    """Records timed spans, from any thread, and writes them
+    on close as json lines or in Chrome trace format.
+    """
+    def __init__(self, filename, format='jsonl'):
+        self.filename = filename
+        self.format = format
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def record(self, name, category, start, end, attributes):
+        event = dict(
+            name=name,
+            cat=category,
+            ts=round((start - self.origin) * 1e6),
+            dur=round((end - start) * 1e6),
+            tid=threading.get_ident(),
+            args=attributes,
+        )
+        with self.lock:
+            self.events.append(event)
+
+    def _write(self):
+        with open(str(self.filename), 'w', encoding='utf8') as output:
+            if self.format == 'chrome':
+                json.dump(dict(traceEvents=[
+                    dict(event, ph='X', pid=1)
+                    for event in self.events
+                ]), output, default=str)
+                return
+            for event in self.events:
+                output.write(json.dumps(event, default=str) + '\n')
+
+    def summary(self):
+        "Text with the time spent per category of span"
+        totals = defaultdict(lambda: dict(count=0, dur=0, bytes=0))
+        for event in self.events:
+            total = totals[event['cat']]
+            total['count'] += 1
+            total['dur'] += event['dur']
+            total['bytes'] += event['args'].get('bytes') or 0
+        elapsed = time.perf_counter() - self.origin
+        lines = ["Trace written to {} ({:.2f}s elapsed, span times add up all threads)".format(
+            self.filename, elapsed)]
+        for category, total in sorted(totals.items(), key=lambda item: -item[1]['dur']):
+            lines.append("  {:<8} {:>7} spans {:>9.2f}s{}".format(
+                category,
+                total['count'],
+                total['dur'] / 1e6,
+                " {:>12} bytes".format(total['bytes']) if total['bytes'] else "",
+            ))
+        return "\n".join(lines)
+
+    def close(self):
+        self._write()
+        return self.summary()
+
+
+_tracer = None
+
+def startTracing(filename, format=None):
+    """Starts recording spans into filename.
+    Chrome trace format is used for .json files if format is not given.
+    """
+    global _tracer
+    if format is None:
+        format = 'chrome' if str(filename).endswith('.json') else 'jsonl'
+    _tracer = Tracer(filename, format)
+    return _tracer
+
+def stopTracing():
+    "Writes the spans and returns the summary, None if not tracing"
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return None
+    return tracer.close()
+
+@contextmanager
+def span(name, category, **attributes):
+    """Times the enclosed code when tracing.
+    Yields the attributes dict so that the code can add results.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield attributes
+        return
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        tracer.record(name, category, start, time.perf_counter(), attributes)
@@ -0,0 +1,67 @@
+# Where the uploader reads the file objects from
+
+from pathlib import Path
+from fnmatch import fnmatch
+from .serialization import loadYaml
+
+class FileTree(object):
+    "File objects in the working directory"
+
+    def __init__(self, repopath):
+        self.repopath = Path(repopath)
+
+    def load(self, path):
+        "Content of a YAML file"
+        return loadYaml(self.repopath/path)
+
+    def read(self, path):
+        "Text of a file"
+        return (self.repopath/path).read_text(encoding='utf8')
+
+    def glob(self, path, pattern):
+        "Sorted paths matching pattern within path"
+        return sorted(
+            filename.relative_to(self.repopath)
+            for filename in (self.repopath/path).glob(pattern)
+        )
+
+class NameIndex(object):
+    "Globbing over the names of the files known in every folder"
+
+    def _addName(self, path):
+        path = Path(path)
+        self._children.setdefault(str(path.parent), []).append(path.name)
+
+    def glob(self, path, pattern):
+        "Sorted paths matching pattern within path"
+        pattern = Path(path)/pattern
+        directory = pattern.parent
+        return sorted(
+            directory/name
+            for name in self._children.get(str(directory), [])
+            if fnmatch(name, pattern.name)
+        )
+
+class MemoryTree(NameIndex):
+    """File objects held in memory, by path, already loaded:
+    namespaces for the YAML files and text for the rest.
+    """
+    def __init__(self):
+        self.files = {}
+        self._children = {}
+
+    def put(self, path, content):
+        path = Path(path)
+        if str(path) not in self.files:
+            self._addName(path)
+        self.files[str(path)] = content
+
+    def load(self, path):
+        return self.files[str(path)]
+
+    def read(self, path):
+        return self.files[str(path)]
+
+    def items(self):
+        "(path, content) of every file, in the order they were put"
+        return ((Path(path), content) for path, content in self.files.items())
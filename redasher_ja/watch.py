@@ -0,0 +1,168 @@
+# Watching the file objects for changes
+
+import os
+import time
+import threading
+
+suffixes = ('.yaml', '.sql')
+
+def createWatcher(paths, interval=0.2, debounce=0.3):
+    """Builds a watcher for the paths, notified by the system
+    when watchdog is installed, or polling them otherwise.
+    """
+    try:
+        import watchdog.observers
+    except ImportError:
+        return Watcher(paths, interval=interval, debounce=debounce)
+    return NotifyWatcher(paths, interval=interval, debounce=debounce)
+
+class Watcher(object):
+    """Polls the YAML and SQL files under some paths, hidden ones
+    aside, comparing their modification time and size.
+    Bursts of changes, as editors saving several files or
+    writing them in steps, are reported together once
+    no further change is seen for `debounce` seconds.
+    """
+    suffixes = suffixes
+    polling = True
+
+    def __init__(self, paths, interval=0.2, debounce=0.3):
+        self.paths = [os.path.normpath(str(path)) for path in paths]
+        self.interval = interval
+        self.debounce = debounce
+        self.signatures = self._scan()
+
+    def _scan(self):
+        "Signature of every watched file by path"
+        signatures = {}
+
+        def add(path, stat):
+            try:
+                stat = stat()
+            except FileNotFoundError:
+                return
+            signatures[path] = (stat.st_mtime_ns, stat.st_size)
+
+        def walk(directory):
+            try:
+                entries = os.scandir(directory)
+            except (FileNotFoundError, NotADirectoryError):
+                return
+            with entries:
+                for entry in entries:
+                    if entry.name.startswith('.'): continue
+                    if entry.is_dir():
+                        walk(entry.path)
+                    elif entry.name.endswith(self.suffixes):
+                        add(entry.path, entry.stat)
+
+        for path in self.paths:
+            if os.path.isdir(path):
+                walk(path)
+            elif path.endswith(self.suffixes):
+                add(path, lambda: os.stat(path))
+        return signatures
+
+    def _changes(self):
+        "Files added, modified or removed since the last scan"
+        signatures = self._scan()
+        changed = set(self.signatures) - set(signatures)
+        changed.update(
+            path for path, signature in signatures.items()
+            if self.signatures.get(path) != signature
+        )
+        self.signatures = signatures
+        return changed
+
+    def changes(self):
+        "Yields, endlessly, the set of files changed in every burst"
+        while True:
+            changed = self._changes()
+            if not changed:
+                time.sleep(self.interval)
+                continue
+            quiet = time.monotonic()
+            while time.monotonic() - quiet < self.debounce:
+                time.sleep(min(self.interval, self.debounce))
+                more = self._changes()
+                if more:
+                    changed |= more
+                    quiet = time.monotonic()
+            yield changed
+
+class NotifyWatcher(Watcher):
+    """Watches the same files as Watcher but, instead of polling,
+    gets the changes from the system (inotify, FSEvents...)
+    through watchdog, so idle watching costs nothing
+    whatever the number of files.
+    """
+    polling = False
+
+    def __init__(self, paths, interval=0.2, debounce=0.3):
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+        self.paths = [os.path.normpath(str(path)) for path in paths]
+        self.interval = interval
+        self.debounce = debounce
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+
+        watcher = self
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory: return
+                watcher._notify(event.src_path, getattr(event, 'dest_path', ''))
+
+        self.observer = Observer()
+        for path in self.paths:
+            if os.path.isdir(path):
+                self.observer.schedule(Handler(), path, recursive=True)
+            else: # just the file, editors replace it within its folder
+                self.observer.schedule(Handler(), os.path.dirname(path) or '.')
+        self.observer.daemon = True
+        self.observer.start()
+
+    def _watched(self, path):
+        path = os.path.normpath(path)
+        if not path.endswith(self.suffixes):
+            return False
+        for watched in self.paths:
+            if path == watched:
+                return True
+            relative = os.path.relpath(path, watched)
+            if relative.startswith(os.pardir): continue
+            if not os.path.isdir(watched): continue
+            return not any(part.startswith('.') for part in relative.split(os.sep))
+        return False
+
+    def _notify(self, *paths):
+        paths = [os.path.normpath(path) for path in paths if path and self._watched(path)]
+        if not paths: return
+        with self._lock:
+            self._pending.update(paths)
+        self._changed.set()
+
+    def _changes(self):
+        "Files notified since the last call"
+        with self._lock:
+            changed, self._pending = self._pending, set()
+            self._changed.clear()
+        return changed
+
+    def changes(self):
+        try:
+            while True:
+                # With a timeout, so that Ctrl-C gets through
+                while not self._changed.wait(self.interval):
+                    pass
+                changed = self._changes()
+                quiet = time.monotonic()
+                while time.monotonic() - quiet < self.debounce:
+                    if self._changed.wait(self.debounce - (time.monotonic() - quiet)):
+                        changed |= self._changes()
+                        quiet = time.monotonic()
+                if changed:
+                    yield changed
+        finally:
+            self.observer.stop()
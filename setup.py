@@ -19,6 +19,9 @@ setup(
     ],
     packages = find_packages(exclude=['*[tT]est*']),
     install_requires = read('requirements.txt').splitlines(),
+    extras_require = dict(
+        watch = ['watchdog'],
+    ),
     python_requires='>=3.7',
     classifiers=[
         "Programming Language :: Python :: 3.11",
@@ -0,0 +1,41 @@
+import os
+import sys
+import subprocess
+import pytest
+from pathlib import Path
+
+repopath = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(repopath))
+sys.path.insert(0, str(repopath/'benchmarks'))
+from fakeredash import serve
+
+@pytest.fixture
+def fakeServer():
+    "Serves fake Redash instances, stopping them at the end"
+    servers = []
+    def start(redash):
+        server = serve(redash)
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def redasher(tmp_path):
+    """Runs the command line in an empty working directory,
+    failing unless it succeeds or check is False"""
+    def run(*args, check=True):
+        result = subprocess.run(
+            [sys.executable, '-m', 'redasher_ja.cli'] + [str(arg) for arg in args],
+            cwd=str(tmp_path),
+            env=dict(os.environ, PYTHONPATH=str(repopath)),
+            capture_output=True,
+            text=True,
+        )
+        if check:
+            assert result.returncode == 0, result.stderr
+        return result
+    run.workdir = tmp_path
+    return run
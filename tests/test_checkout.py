@@ -0,0 +1,99 @@
+from yamlns import namespace as ns
+from fakeredash import FakeRedash
+from redasher_ja.repo import Selector
+
+def load(path):
+    return ns.load(str(path))
+
+def parameterQueryIds(workdir):
+    return [
+        parameter.queryId
+        for metadata in workdir.glob('queries/*/metadata.yaml')
+        for parameter in load(metadata).options.get('parameters', [])
+        if 'queryId' in parameter
+    ]
+
+def bindDataSources(redasher, target, servername):
+    for i, datasource in enumerate(sorted(redasher.workdir.glob('datasources/*.yaml'))):
+        redasher('bind', servername, 'datasource',
+            datasource.relative_to(redasher.workdir), sorted(target.datasources)[i])
+
+def test_selector_idsApplyToTheirOwnType():
+    selector = Selector(dashboardIds=[12])
+    assert selector.matches('dashboard', dict(id=12))
+    assert not selector.matches('query', dict(id=12))
+    selector = Selector(queryIds=[12], tags=['kpi'])
+    assert selector.matches('query', dict(id=12, tags=['kpi']))
+    assert not selector.matches('dashboard', dict(id=12, tags=['kpi']))
+
+def test_checkoutAll_selectedQueries_bringTheirParameterQueries(redasher, fakeServer):
+    source = FakeRedash().generate(queries=100, dashboards=0, seed=1)
+    kpi = [id for id, query in source.queries.items() if 'kpi' in query['tags']]
+    outside = [
+        parameter['queryId']
+        for id in kpi
+        for parameter in source.queries[id]['options']['parameters']
+        if parameter['queryId'] not in kpi
+    ]
+    assert outside, "the data should have parameter queries out of the selection"
+    redasher('setup', 'src', fakeServer(source).url, 'key')
+
+    redasher('checkout-all', 'src', '--tag', 'kpi')
+
+    ids = parameterQueryIds(redasher.workdir)
+    assert ids and all(isinstance(id, str) for id in ids)
+    assert all((redasher.workdir/id/'metadata.yaml').exists() for id in ids)
+
+def test_checkoutAll_selectedDashboard_bringsItsQueries(redasher, fakeServer):
+    source = FakeRedash().generate(queries=30, dashboards=3, widgets=4, seed=2)
+    dashboardId = list(source.dashboards)[0]
+    redasher('setup', 'src', fakeServer(source).url, 'key')
+
+    redasher('checkout-all', 'src', '--dashboard-ids', dashboardId)
+
+    widgets = [load(widget) for widget in redasher.workdir.glob('dashboards/*/widgets/*.yaml')]
+    withVisualization = [
+        widget for widget in source.widgets.values()
+        if widget['dashboard_id'] == dashboardId and widget['visualization_id']
+    ]
+    visualizations = [widget.visualization for widget in widgets if widget.get('visualization')]
+    assert len(visualizations) == len(withVisualization)
+    assert all((redasher.workdir/path).exists() for path in visualizations)
+
+def test_upload_afterSelectiveCheckout(redasher, fakeServer):
+    source = FakeRedash().generate(queries=100, dashboards=3, widgets=4, seed=1)
+    target = FakeRedash().generate(queries=0, dashboards=0)
+    redasher('setup', 'src', fakeServer(source).url, 'key')
+    redasher('setup', 'dst', fakeServer(target).url, 'key')
+    kpi = [id for id, query in source.queries.items() if 'kpi' in query['tags']]
+    redasher('checkout-all', 'src',
+        '--query-ids', ','.join(map(str, kpi)),
+        '--dashboard-ids', ','.join(map(str, source.dashboards)),
+    )
+    bindDataSources(redasher, target, 'dst')
+
+    dashboards = sorted(redasher.workdir.glob('dashboards/*'))
+    queries = sorted(redasher.workdir.glob('queries/*'))
+    redasher('upload', 'dst', *[path.relative_to(redasher.workdir) for path in dashboards + queries])
+
+    assert dashboards and len(queries) > len(kpi)
+    assert len(target.queries) == len(queries)
+    assert (
+        sorted(bool(widget['visualization_id']) for widget in target.widgets.values()) ==
+        sorted(bool(widget['visualization_id']) for widget in source.widgets.values())
+    )
+
+def test_upload_serverIdReference_failsClearly(redasher, fakeServer):
+    source = FakeRedash().generate(queries=5, dashboards=0, seed=1)
+    redasher('setup', 'src', fakeServer(source).url, 'key')
+    redasher('checkout-all', 'src')
+    metadatafile = sorted(redasher.workdir.glob('queries/*/metadata.yaml'))[0]
+    metadata = load(metadatafile)
+    metadata.options.parameters = [ns(name='filter', type='query', queryId=12345)]
+    metadata.dump(str(metadatafile))
+
+    result = redasher('upload', 'src', metadatafile.parent.relative_to(redasher.workdir), check=False)
+
+    assert result.returncode != 0
+    assert 'Traceback' not in result.stderr
+    assert 'refers to the query with id 12345' in result.stderr
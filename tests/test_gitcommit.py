@@ -0,0 +1,56 @@
+import subprocess
+import pytest
+from redasher_ja.gitcommit import GitCommit
+
+def git(repo, *args):
+    return subprocess.run(['git'] + list(args), cwd=str(repo), check=True,
+        stdout=subprocess.PIPE, text=True).stdout
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    "A repository with one commit and no identity other than its own config"
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('GIT_CONFIG_NOSYSTEM', '1')
+    for variable in ('AUTHOR', 'COMMITTER'):
+        for field in ('NAME', 'EMAIL'):
+            monkeypatch.delenv('GIT_{}_{}'.format(variable, field), raising=False)
+    repo = tmp_path/'repo'
+    repo.mkdir()
+    git(repo, 'init', '-q', '-b', 'main')
+    git(repo, 'config', 'user.useConfigOnly', 'true')
+    git(repo, 'config', 'user.name', 'Tester')
+    git(repo, 'config', 'user.email', 'tester@example.com')
+    (repo/'README').write_text('readme\n')
+    git(repo, 'add', 'README')
+    git(repo, 'commit', '-q', '-m', 'first')
+    return repo
+
+def test_commit_currentBranch_keepsStagedFiles(repo):
+    (repo/'notes.txt').write_text('notes\n')
+    git(repo, 'add', 'notes.txt')
+    commit = GitCommit(repo)
+    commit.add('queries/sales.yaml', 'name: Sales\n')
+    commit.commit('Checkout')
+
+    assert git(repo, 'show', 'main:queries/sales.yaml') == 'name: Sales\n'
+    assert git(repo, 'status', '--porcelain') == (
+        'A  notes.txt\n'
+        ' D queries/sales.yaml\n'
+    )
+    assert 'notes.txt' not in git(repo, 'ls-tree', '-r', '--name-only', 'main')
+
+def test_init_withoutIdentity_failsBeforeStreaming(repo):
+    git(repo, 'config', '--unset', 'user.email')
+    with pytest.raises(SystemExit):
+        GitCommit(repo)
+    assert not list((repo/'.git').glob('fast_import_crash_*'))
+
+def test_abort_midstream_leavesNoCrashReport(repo):
+    commit = GitCommit(repo)
+    commit.add('queries/sales.yaml', 'name: Sales\n')
+    with pytest.raises(TypeError):
+        commit._send('blob\nmark :9\ndata 10\n', 'half', None)
+    commit.abort()
+
+    assert not list((repo/'.git').glob('fast_import_crash_*'))
+    assert git(repo, 'log', '--format=%s') == 'first\n'
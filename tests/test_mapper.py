@@ -0,0 +1,48 @@
+from pathlib import Path
+from yamlns import namespace as ns
+from redasher_ja.mapper import Mapper, SqliteMapper
+
+def bindSome(mapper):
+    mapper.bind('query', 1, Path('queries')/'sales.yaml')
+    mapper.bind('query', 2, Path('queries')/'old'/'sales-2.yaml')
+    mapper.bind('dashboard', 3, Path('dashboards')/'sales.yaml')
+    mapper.bind('query', 4, Path('queries-old')/'sales-3.yaml')
+    mapper.flush()
+
+def test_track_boundNames_yaml(tmp_path):
+    mapper = Mapper(tmp_path, 'server')
+    bindSome(mapper)
+    path = mapper.track('query', Path('queries'), ns(id=5, name='sales'), suffix='.yaml')
+    assert path == Path('queries')/'sales-2.yaml'
+
+def test_track_boundNames_sqlite(tmp_path):
+    mapper = SqliteMapper(tmp_path, 'server')
+    bindSome(mapper)
+    mapper.bindings = None # the whole map is not loaded
+    path = mapper.track('query', Path('queries'), ns(id=5, name='sales'), suffix='.yaml')
+    assert path == Path('queries')/'sales-2.yaml'
+
+def test_boundNamesIn_sqlite_onlyDirectChildrenOfThisServer(tmp_path):
+    other = SqliteMapper(tmp_path, 'other')
+    other.bind('query', 6, Path('queries')/'kpi.yaml')
+    other.flush()
+    mapper = SqliteMapper(tmp_path, 'server')
+    bindSome(mapper)
+    assert mapper._boundNamesIn('queries') == {'sales.yaml'}
+
+def test_sqlite_twoServersBindingAtOnce(tmp_path):
+    source = SqliteMapper(tmp_path, 'source')
+    target = SqliteMapper(tmp_path, 'target')
+    source.bind('query', 1, Path('queries')/'sales.yaml')
+    target.bind('query', 10, Path('queries')/'sales.yaml')
+    source.bind('query', 2, Path('queries')/'kpi.yaml')
+    target.bind('query', 20, Path('queries')/'kpi.yaml')
+    # bindings are visible to another connection before any flush
+    reader = SqliteMapper(tmp_path, 'target')
+    assert reader.remoteId('query', Path('queries')/'kpi.yaml') == 20
+    source.flush()
+    target.flush()
+    assert SqliteMapper(tmp_path, 'source').bindings() == ns(query=ns({
+        1: 'queries/sales.yaml',
+        2: 'queries/kpi.yaml',
+    }))
@@ -0,0 +1,50 @@
+import time
+from redasher_ja.redash import RateLimiter
+
+def burst(limiter, count, interval=0.):
+    for i in range(count):
+        limiter.acquire()
+        limiter.speedUp()
+        time.sleep(interval)
+
+def test_rateLimiter_unconfigured_doesNotWait():
+    limiter = RateLimiter()
+    start = time.monotonic()
+    burst(limiter, 100)
+    assert limiter.rate is None
+    assert time.monotonic() - start < 0.5
+
+def test_rateLimiter_slowDown_halvesMeasuredRate():
+    limiter = RateLimiter()
+    burst(limiter, 10, interval=0.05) # about 20 per second
+    limiter.slowDown()
+    assert 6 < limiter.rate < 12
+
+def test_rateLimiter_slowDown_onceASecond():
+    limiter = RateLimiter()
+    burst(limiter, 10, interval=0.05)
+    limiter.slowDown()
+    rate = limiter.rate
+    limiter.slowDown()
+    assert limiter.rate == rate
+
+def test_rateLimiter_unconfigured_liftsLimitAfterRecovering():
+    limiter = RateLimiter()
+    burst(limiter, 10, interval=0.05)
+    limiter.slowDown()
+    start = time.monotonic()
+    while limiter.rate is not None and time.monotonic() - start < 5:
+        burst(limiter, 1)
+    assert limiter.rate is None
+    assert time.monotonic() - start < 2.5
+
+def test_rateLimiter_configured_recoversUpToConfigured():
+    limiter = RateLimiter(40)
+    burst(limiter, 20)
+    limiter.slowDown()
+    assert limiter.rate <= 20
+    start = time.monotonic()
+    while limiter.rate != 40 and time.monotonic() - start < 5:
+        burst(limiter, 1)
+    assert limiter.rate == 40
+    assert time.monotonic() - start < 2.5
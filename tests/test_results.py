@@ -0,0 +1,39 @@
+import json
+from redasher_ja.results import downloadQueryResult
+
+class Response(object):
+    "Stands for a streamed requests response"
+    def __init__(self, document):
+        self.content = json.dumps(document).encode('utf8')
+    def iter_content(self, chunksize):
+        for start in range(0, len(self.content), 7):
+            yield self.content[start:start+7]
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        pass
+
+def queryResult(rows):
+    return dict(query_result=dict(id=1, data=dict(
+        columns=[dict(name='n', type='integer')],
+        rows=[dict(n=n) for n in range(rows)],
+    )))
+
+def test_downloadQueryResult_writesRowsAndSummary(tmp_path):
+    result = downloadQueryResult(Response(queryResult(3)), tmp_path, 1000)
+    assert result.rows == 3
+    assert (tmp_path/'results.ndjson').read_text() == '{"n":0}\n{"n":1}\n{"n":2}\n'
+    assert result.written == [tmp_path/'results.ndjson', tmp_path/'results.yaml']
+    assert result.unchanged == []
+
+def test_downloadQueryResult_sameContent_writesNothing(tmp_path):
+    downloadQueryResult(Response(queryResult(3)), tmp_path, 1000)
+    result = downloadQueryResult(Response(queryResult(3)), tmp_path, 1000)
+    assert result.written == []
+    assert result.unchanged == [tmp_path/'results.ndjson', tmp_path/'results.yaml']
+
+def test_downloadQueryResult_truncated(tmp_path):
+    result = downloadQueryResult(Response(queryResult(100)), tmp_path, 20)
+    assert result.truncated
+    assert result.rows == 2
+    assert not list(tmp_path.glob('.*.tmp'))
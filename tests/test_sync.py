@@ -0,0 +1,51 @@
+from yamlns import namespace as ns
+from fakeredash import FakeRedash
+
+def setupServers(redasher, fakeServer, source, target, **settings):
+    """Sets up src and dst with the given settings,
+    binding the source data sources to the target ones by name"""
+    redasher('setup', 'src', fakeServer(source).url, 'key')
+    redasher('setup', 'dst', fakeServer(target).url, 'key')
+    if settings:
+        configfile = redasher.workdir/'.redasher-ja'/'config.yaml'
+        config = ns.load(str(configfile))
+        for server in config.servers.values():
+            server.update(settings)
+        config.dump(str(configfile))
+    redasher('checkout-all', 'src') # binds the source data sources
+    for datasourceId, targetId in zip(sorted(source.datasources), sorted(target.datasources)):
+        redasher('bind', 'dst', 'datasource', 'datasources/{}.yaml'.format(
+            'postgres' if source.datasources[datasourceId]['name'] == 'Postgres'
+            else 'data-warehouse'), targetId)
+
+def test_sync_selection_twice(redasher, fakeServer):
+    source = FakeRedash().generate(queries=100, dashboards=3, widgets=3, seed=1)
+    target = FakeRedash().generate(queries=0, dashboards=0)
+    setupServers(redasher, fakeServer, source, target)
+
+    redasher('sync', 'src', 'dst', '--tag', 'kpi')
+    synced = len(target.queries)
+    redasher('sync', 'src', 'dst', '--tag', 'kpi')
+
+    assert synced and len(target.queries) == synced
+
+def test_sync_sqliteMaps_newQueries(redasher, fakeServer):
+    source = FakeRedash().generate(queries=30, dashboards=2, widgets=3, seed=2)
+    target = FakeRedash().generate(queries=0, dashboards=0)
+    setupServers(redasher, fakeServer, source, target, mapstore='sqlite')
+
+    redasher('sync', 'src', 'dst')
+    model = source.queries[min(source.queries)]
+    for n in range(4):
+        source.post('api/queries', dict(model,
+            name='New {}'.format(n),
+            query='SELECT {}'.format(n),
+            options=dict(parameters=[]),
+        ))
+    redasher('sync', 'src', 'dst')
+    synced = len(target.queries)
+    redasher('sync', 'src', 'dst')
+
+    assert synced == len(source.queries)
+    assert len(target.queries) == synced
+    assert not (redasher.workdir/'maps'/'dst.yaml').exists()
@@ -0,0 +1,49 @@
+import time
+import threading
+import consolemsg
+from yamlns import namespace as ns
+from fakeredash import FakeRedash
+from redasher_ja.repo import Uploader
+
+def test_upload_affectedBy_dataSource_uploadsTheQueriesUsingIt(redasher, fakeServer):
+    source = FakeRedash().generate(queries=20, dashboards=2, widgets=3, seed=1)
+    redasher('setup', 'src', fakeServer(source).url, 'key')
+    redasher('checkout-all', 'src')
+    datasourceId, datasource = sorted(
+        ns.load(str(redasher.workdir/'maps'/'src.yaml')).datasource.items())[0]
+    original = {id: query['query'] for id, query in source.queries.items()}
+    for query in source.queries.values():
+        query['query'] += '-- edited in the server\n'
+
+    result = redasher('upload', 'src', '--affected-by', datasource)
+
+    assert 'Unsuported' not in result.stderr
+    restored = [id for id, query in source.queries.items() if query['query'] == original[id]]
+    using = [id for id, query in source.queries.items() if query['data_source_id'] == datasourceId]
+    assert using and set(using) <= set(restored)
+    assert len(restored) < len(source.queries)
+
+def test_uploader_step_fromSeveralJobs_keepsLinesWhole(monkeypatch):
+    class SlowStream(object):
+        "Yields the thread between writes, as a busy terminal would"
+        def __init__(self):
+            self.written = []
+        def write(self, text):
+            self.written.append(text)
+            time.sleep(0.001)
+        def flush(self):
+            pass
+    stream = SlowStream()
+    monkeypatch.setattr(consolemsg.stderr, 'cached', stream, raising=False)
+    uploader = Uploader.__new__(Uploader) # no server needed to report
+    jobs = [
+        threading.Thread(target=lambda n=n: [
+            uploader.step("Create visualization {}", n) for i in range(20)])
+        for n in range(4)
+    ]
+    for job in jobs: job.start()
+    for job in jobs: job.join()
+
+    lines = ''.join(stream.written).splitlines()
+    assert len(lines) == 80
+    assert all(line.count('Create') == 1 for line in lines)
@@ -0,0 +1,47 @@
+import threading
+import pytest
+from redasher_ja.watch import Watcher, NotifyWatcher
+
+def nextChanges(watcher, change):
+    "The first burst of changes the watcher reports after change() runs"
+    threading.Timer(0.1, change).start()
+    return next(watcher.changes())
+
+@pytest.fixture(params=['polling', 'notified'])
+def watcherClass(request):
+    if request.param == 'notified':
+        pytest.importorskip('watchdog')
+        return NotifyWatcher
+    return Watcher
+
+@pytest.fixture
+def queries(tmp_path):
+    (tmp_path/'queries'/'sales').mkdir(parents=True)
+    (tmp_path/'queries'/'sales'/'metadata.yaml').write_text('name: Sales\n')
+    return tmp_path/'queries'
+
+def test_changes_burstTogether(watcherClass, queries):
+    watcher = watcherClass([queries], interval=0.05, debounce=0.2)
+    def change():
+        (queries/'sales'/'metadata.yaml').write_text('name: Sales 2\n')
+        (queries/'sales'/'query.sql').write_text('SELECT 1\n')
+    assert nextChanges(watcher, change) == {
+        str(queries/'sales'/'metadata.yaml'),
+        str(queries/'sales'/'query.sql'),
+    }
+
+def test_changes_ignoresHiddenAndOtherFiles(watcherClass, queries):
+    watcher = watcherClass([queries], interval=0.05, debounce=0.2)
+    def change():
+        (queries/'sales'/'.metadata.yaml.swp').write_text('swap')
+        (queries/'sales'/'notes.txt').write_text('notes')
+        (queries/'sales'/'query.sql').write_text('SELECT 1\n')
+    assert nextChanges(watcher, change) == {str(queries/'sales'/'query.sql')}
+
+def test_changes_singleFile(watcherClass, queries):
+    metadata = queries/'sales'/'metadata.yaml'
+    watcher = watcherClass([metadata], interval=0.05, debounce=0.2)
+    def change():
+        (queries/'sales'/'query.sql').write_text('SELECT 1\n')
+        metadata.write_text('name: Sales 2\n')
+    assert nextChanges(watcher, change) == {str(metadata)}